@@ -0,0 +1,129 @@
+# Runs a grid of simulations (the runs of simu_script.py) on the local machine, without a job scheduler:
+#
+#   python grid_runner.py outdir --s_B 0.2 0.4 0.6 --int_mean 10 15 20 --seed_B_range 1 10 --seed_m 1 2 5 --cores 32
+#
+# Seeds are given either as a list (--seed_B, --seed_m) or as an inclusive range (--seed_B_range, --seed_m_range).
+# A "random" DAG needs its number of variables --p. The DAG setting of each (dag_type, s_B, seed_B) is built once,
+# saved in outdir/settings and shared by all its (int_mean, seed_m) replicates; the cells of a setting that cannot be
+# built count as failed. Replicates run on a pool of cores // ncore processes, each using ncore cores. Cells
+# whose output file exists are skipped, so an interrupted grid is resumed by running the same command again
+import argparse
+import itertools
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+from simu_script import make_setting, outfile_name, run_replicate, lasso_engines
+
+
+# `p` is that of a random DAG, None for a hub DAG
+def setting_file(outdir, dag_type, s_B, seed_B, p=None):
+    return os.path.join(outdir, "settings", "setting" + dag_type + ("" if p is None else "p" + str(p)) + "_s" +
+                        str(int(s_B*10)) + "seedB" + str(seed_B) + ".npz")
+
+# builds the setting of (dag_type, s_B, seed_B, p) and saves it, under a temporary name renamed when complete
+def build_setting(dag_type, s_B, seed_B, p, path):
+    B, sigma2_error, b, order = make_setting(dag_type, s_B, seed_B, p)
+    with open(path + ".part", "wb") as io:
+        np.savez(io, B=B, sigma2_error=sigma2_error, b=b, order=order)
+    os.replace(path + ".part", path)
+    return path
+
+_settings = {}  # settings loaded by this worker process, by file
+
+def load_setting(path):
+    if path not in _settings:
+        with np.load(path) as data:
+            _settings[path] = (data["B"], data["sigma2_error"], data["b"], data["order"])
+    return _settings[path]
+
+def run_cell(setting_path, int_mean, dimreduce_method, ncore, seed_m, outfile):
+    start = time.perf_counter()
+    run_replicate(load_setting(setting_path), int_mean, dimreduce_method, ncore, seed_m, outfile)
+    return time.perf_counter() - start
+
+# seeds given as a list, or else as an inclusive range [first, last] (1 to 10 if neither is given)
+def seed_list(values, first_last):
+    if values is not None:
+        return values
+    first, last = first_last or (1, 10)
+    return list(range(first, last + 1))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a grid of root cause discovery simulations locally")
+    parser.add_argument("outdir")
+    parser.add_argument("--dag_type", nargs="+", default=["hub"], choices=["hub", "random"])
+    parser.add_argument("--p", type=int, help="number of variables of a random DAG")
+    parser.add_argument("--s_B", nargs="+", type=float, default=[0.2, 0.4, 0.6])
+    parser.add_argument("--int_mean", nargs="+", type=int, default=[10, 15, 20])
+    parser.add_argument("--dimreduce_method", nargs="+", default=["sklearn"], choices=list(lasso_engines))
+    for seed in ["seed_B", "seed_m"]:
+        group = parser.add_mutually_exclusive_group()
+        group.add_argument("--" + seed, nargs="+", type=int, help="list of seeds")
+        group.add_argument("--" + seed + "_range", nargs=2, type=int, metavar=("FIRST", "LAST"),
+                           help="seeds FIRST to LAST (default 1 10)")
+    parser.add_argument("--cores", type=int, default=os.cpu_count(), help="total number of cores to use")
+    parser.add_argument("--ncore", type=int, default=1, help="cores of each simulation")
+    args = parser.parse_args(argv)
+    if "random" in args.dag_type and args.p is None:
+        parser.error("--p is needed for a random DAG")
+    seeds_B = seed_list(args.seed_B, args.seed_B_range)
+    seeds_m = seed_list(args.seed_m, args.seed_m_range)
+    os.makedirs(os.path.join(args.outdir, "settings"), exist_ok=True)
+    workers = max(1, args.cores // args.ncore)
+
+    # cells still to run, grouped by setting
+    todo = {}
+    n_cells = 0
+    for dag_type, s_B, seed_B, int_mean, dimreduce_method, seed_m in itertools.product(
+            args.dag_type, args.s_B, seeds_B, args.int_mean, args.dimreduce_method, seeds_m):
+        n_cells += 1
+        p = args.p if dag_type == "random" else None
+        outfile = outfile_name(args.outdir, dag_type, dimreduce_method, s_B, int_mean, seed_B, seed_m, p)
+        if not os.path.exists(outfile):
+            todo.setdefault((dag_type, s_B, seed_B, p), []).append((int_mean, dimreduce_method, seed_m, outfile))
+    n_todo = sum(len(cells) for cells in todo.values())
+    print(f"{n_cells - n_todo} of {n_cells} cells done, running {n_todo} on {workers} processes of {args.ncore} cores",
+          flush=True)
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # settings that are not saved yet are built first, in parallel
+        paths = {key: setting_file(args.outdir, *key) for key in todo}
+        builds = {pool.submit(build_setting, *key, path): key for key, path in paths.items()
+                  if not os.path.exists(path)}
+        for future in as_completed(builds):
+            try:
+                future.result()
+            except Exception:
+                key = builds[future]
+                failed += len(todo.pop(key))
+                print(f"setting {os.path.basename(paths[key])} failed, skipping its cells:\n{traceback.format_exc()}",
+                      flush=True)
+
+        cells = {pool.submit(run_cell, paths[key], int_mean, dimreduce_method, args.ncore, seed_m, outfile): outfile
+                 for key, group in todo.items() for int_mean, dimreduce_method, seed_m, outfile in group}
+        for i, future in enumerate(as_completed(cells)):
+            try:
+                seconds = future.result()
+                print(f"[{i + 1}/{len(cells)}] {os.path.basename(cells[future])} in {seconds:.1f}s", flush=True)
+            except Exception:
+                failed += 1
+                print(f"[{i + 1}/{len(cells)}] {os.path.basename(cells[future])} failed:\n{traceback.format_exc()}",
+                      flush=True)
+
+    if failed > 0:
+        print(f"{failed} cells failed, run the same command again to retry them")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,18 +8,6 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from funcs.root_cause_discovery_funcs import *
 from funcs.simulation_setting_funcs import *
 
-# parameters for simulations (run in different cores)
-s_B = float(sys.argv[1])      # 0.2, 0.4, or 0.6
-int_mean = int(sys.argv[2])   # 10, 15, or 20
-dag_type = sys.argv[3]
-dimreduce_method = sys.argv[4]
-ncore = int(sys.argv[5])
-seed_B = int(sys.argv[6])  # 1 to 10
-seed_m = int(sys.argv[7])  # 1 to 10
-outdir = sys.argv[8]          # output directory
-if not os.path.isdir(outdir):
-    os.mkdir(outdir)
-
 # other fixed parameters
 n = 100
 nshuffles = 5
@@ -40,32 +28,84 @@ err_max = 5
 var_X_min = 10
 var_X_max = 50
 
-# generate data
-np.random.seed(seed_B)
-B, sigma2_error, b = generate_setting(dag_type, s_B, B_value_min, B_value_max, err_min, err_max, var_X_min, var_X_max,
-                                      num_hub=num_hub, size_up_block=size_up_block,
-                                      size_low_block=size_low_block, intersect_prop=intersect_prop)
-p = len(b)
-
-# Precision matrix to get true MB
-I = np.eye(p)
-Precision_mat = (I - B).T @ np.diag(1/np.diag(sigma2_error)) @ (I - B)
-
-### Start simulations
-np.random.seed(seed_m)
-X_obs, X_int, RC = generate_data(n, 1, p, B, sigma2_error, b, int_mean, int_sd)
-X_int = X_int[0,:]
-
-# z score method
-Zscores = zscore(X_obs, X_int)
-
-# our main score method
-CholScores_highdim, select_len = root_cause_discovery_highsim_parallel(X_obs, X_int, dimreduce_method, ncore, y_idx_z_threshold, nshuffles, verbose)
-CholScores_highdim_MB, select_len_MB = root_cause_discovery_highsim_parallel(X_obs, X_int, dimreduce_method, ncore, y_idx_z_threshold, nshuffles, verbose, Precision_mat)
-
-# save simulation result
-outfile = os.path.join(outdir, "hd" + dag_type + dimreduce_method + "_s" + str(int(s_B*10)) +
-                       'int' + str(int_mean) + "seedB" + str(seed_B) +
-                       "seedm" + str(seed_m) + '.npz')
-np.savez(outfile, array1=RC, array2=Zscores, array3=CholScores_highdim, array4=CholScores_highdim_MB,
-         array5=select_len, array6=select_len_MB)
\ No newline at end of file
+# `lasso_engine` of root_cause_discovery_highdim_parallel for each dimreduce_method. "cv" is the name used by the
+# earlier scripts (and submit_simuJobs_python.ipynb) for the cross-validated Lasso of each variable, i.e. "sklearn"
+lasso_engines = {"cv": "sklearn", "sklearn": "sklearn", "gram": "gram"}
+
+def lasso_engine_of(dimreduce_method):
+    if dimreduce_method not in lasso_engines:
+        raise ValueError("unknown dimreduce_method " + repr(dimreduce_method) + ", should be one of " +
+                         ", ".join(map(repr, lasso_engines)))
+    return lasso_engines[dimreduce_method]
+
+
+# DAG setting of a seed_B: B, the error variances (a vector), the intercept b and the topological order of B. It does
+# not depend on int_mean or seed_m, so one setting serves all the replicates of its seed_B. `p` is the number of
+# variables of a "random" DAG, that of a "hub" DAG follows from the block sizes
+def make_setting(dag_type, s_B, seed_B, p=None):
+    if dag_type == "random" and p is None:
+        raise ValueError("p is needed for random dag")
+    np.random.seed(seed_B)
+    B, sigma2_error, b, order = generate_setting(dag_type, s_B, B_value_min, B_value_max, err_min, err_max, var_X_min,
+                                                 var_X_max, p=p or 0, num_hub=num_hub, size_up_block=size_up_block,
+                                                 size_low_block=size_low_block, intersect_prop=intersect_prop,
+                                                 return_order=True)
+    return B, np.diag(sigma2_error), b, order
+
+# output file of one replicate (with the `p` of a random DAG, if given)
+def outfile_name(outdir, dag_type, dimreduce_method, s_B, int_mean, seed_B, seed_m, p=None):
+    return os.path.join(outdir, "hd" + dag_type + ("" if p is None else "p" + str(p)) + dimreduce_method + "_s" +
+                        str(int(s_B*10)) + 'int' + str(int_mean) + "seedB" + str(seed_B) +
+                        "seedm" + str(seed_m) + '.npz')
+
+# One replicate on the `setting` of make_setting: data of seed_m, the z scores and our main score without and with the
+# true Markov blankets (`dimreduce_method` selects the `lasso_engine`, see `lasso_engines`), saved to `outfile`. The
+# file is written under a temporary name and renamed, so that an interrupted run leaves no output
+def run_replicate(setting, int_mean, dimreduce_method, ncore, seed_m, outfile):
+    B, sigma2_error, b, order = setting
+    p = len(b)
+    lasso_engine = lasso_engine_of(dimreduce_method)
+
+    # Precision matrix to get true MB
+    Precision_mat = sem_precision(B, sigma2_error)
+
+    ### Start simulations
+    np.random.seed(seed_m)
+    X_obs, X_int, RC = generate_data(n, 1, p, B, sigma2_error, b, int_mean, int_sd, order)
+    X_int = X_int[0,:]
+
+    # z score method
+    Zscores = zscore(X_obs, X_int)
+
+    # our main score method
+    CholScores_highdim, select_len = root_cause_discovery_highdim_parallel(
+        X_obs, X_int, ncore, y_idx_z_threshold, nshuffles, verbose, lasso_engine=lasso_engine)
+    CholScores_highdim_MB, select_len_MB = root_cause_discovery_highdim_parallel(
+        X_obs, X_int, ncore, y_idx_z_threshold, nshuffles, verbose, Precision_mat, lasso_engine=lasso_engine)
+
+    # save simulation result
+    tmpfile = outfile + ".part"
+    with open(tmpfile, "wb") as io:
+        np.savez(io, array1=RC, array2=Zscores, array3=CholScores_highdim, array4=CholScores_highdim_MB,
+                 array5=select_len, array6=select_len_MB)
+    os.replace(tmpfile, outfile)
+
+
+if __name__ == "__main__":
+    # parameters for simulations (run in different cores)
+    s_B = float(sys.argv[1])      # 0.2, 0.4, or 0.6
+    int_mean = int(sys.argv[2])   # 10, 15, or 20
+    dag_type = sys.argv[3]
+    dimreduce_method = sys.argv[4]  # "sklearn" (or "cv") or "gram"
+    ncore = int(sys.argv[5])
+    seed_B = int(sys.argv[6])  # 1 to 10
+    seed_m = int(sys.argv[7])  # 1 to 10
+    outdir = sys.argv[8]          # output directory
+    p = int(sys.argv[9]) if len(sys.argv) > 9 else None  # number of variables of a random DAG
+    lasso_engine_of(dimreduce_method)  # fails before the setting is built
+    if not os.path.isdir(outdir):
+        os.mkdir(outdir)
+
+    setting = make_setting(dag_type, s_B, seed_B, p)
+    run_replicate(setting, int_mean, dimreduce_method, ncore, seed_m,
+                  outfile_name(outdir, dag_type, dimreduce_method, s_B, int_mean, seed_B, seed_m, p))
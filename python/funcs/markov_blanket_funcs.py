@@ -0,0 +1,512 @@
+import os
+import json
+import hashlib
+from functools import partial
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from sklearn.covariance import graphical_lasso
+from sklearn.linear_model import LassoCV, lasso_path
+from joblib import Parallel, delayed
+import warnings  # ignore the warnings
+
+
+# Point of the Lasso path of `y` on `X` (the grid of `lasso_path`) whose support size is closest to `target`.
+# The path is walked from the largest penalty down with warm starts and stops as soon as the support reaches `target`,
+# so only the head of the path is computed. Returns the coefficients and the penalty
+def lasso_target_support(X, y, target, n_alphas=100, eps=1e-3):
+    X = np.asfortranarray(X)  # avoids a copy of X in every call of `lasso_path`
+    Xy = X.T @ y
+    alpha_max = np.max(np.abs(Xy)) / len(y)
+    alphas = np.logspace(np.log10(alpha_max * eps), np.log10(alpha_max), num=n_alphas)[::-1]
+    coef = np.zeros(X.shape[1])
+    best_coef, best_alpha, best_gap = coef, alphas[0], target
+    for alpha in alphas:
+        # `lasso_path` updates `coef_init` in place
+        _, coef_path, _ = lasso_path(X, y, alphas=[alpha], coef_init=coef.copy(), Xy=Xy)
+        coef = coef_path[:, 0]
+        num_nonzeros = np.sum(coef != 0)
+        if np.abs(num_nonzeros - target) < best_gap:
+            best_coef, best_alpha, best_gap = coef, alpha, np.abs(num_nonzeros - target)
+        if num_nonzeros >= target:
+            break
+    return best_coef, best_alpha
+
+
+# Sure independence screening (SIS) of the predictors of column `y_idx` on all other columns: the `size` predictors most
+# correlated with y, from the Gram column `c` = X^T y / n and the Gram diagonal `d` of the centered data.
+# It can discard a predictor of the Lasso solution
+def sis_predictors(c, d, y_idx, size):
+    others = np.delete(np.arange(len(c)), y_idx)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        corr = np.nan_to_num(np.abs(c[others]) / np.sqrt(d[others] * d[y_idx]))
+    return np.sort(others[np.argsort(-corr, kind="stable")[:size]])
+
+
+# Lasso path (n_alphas x p) of the centered `y` on the centered `X` over the descending penalties `alphas`, with the
+# sequential strong rule. The penalties are taken `chunk` at a time: the exact path of a working set of predictors is
+# continued by `lasso_knots` from the Gram matrix of the working set only, then the KKT conditions
+# |x_k^T (y - X beta)| / n <= alpha of all other predictors are checked at these penalties with one product with X.
+# The path is kept up to the first penalty with a violation, where it is continued with the violators added to the
+# working set; a solution that passes the check is the Lasso solution, so the path can be continued from it. The
+# working set starts with `working` and grows with the predictors kept by the sequential strong rule at each next
+# penalty. Penalties at which the path has as many active predictors as the rank of the design (n - 1) are not
+# checked: no predictor can join there
+def strong_rule_path(X, y, alphas, working=None, tol=1e-6, chunk=10):
+    n, p = X.shape
+    c = X.T @ y / n
+    rank = min(n - 1, p)
+    path = np.zeros((len(alphas), p))
+    keep = np.abs(c) >= 2 * alphas[0] - np.max(np.abs(c))
+    if working is not None:
+        keep[working] = True
+    start = None  # last checked point of the path: penalty, active predictors and their coefficients
+    grad_prev, alpha_prev = c, np.max(np.abs(c))
+    i = 0
+    while i < len(alphas):
+        stop = min(i + chunk, len(alphas))
+        idx = np.where(keep)[0]
+        X_work = X[:, idx]
+        gram = X_work.T @ X_work / n
+        start_work = None if start is None else (start[0], np.searchsorted(idx, start[1]), start[2])
+        knots = lasso_knots(c[idx], lambda k: gram[:, k], min(rank, len(idx)), alphas[stop - 1], start=start_work)
+        support, coefs = interpolate_knots(knots, alphas[i:stop])
+        grad = c[:, None] - X.T @ (X_work[:, support] @ coefs.T) / n  # p x (stop - i)
+        violations = (np.abs(grad) > alphas[i:stop] * (1 + tol)) & ~keep[:, None]
+        violations[:, np.sum(coefs != 0, axis=1) >= rank] = False
+        bad = np.where(np.any(violations, axis=0))[0]
+        done = stop - i if len(bad) == 0 else bad[0]  # penalties that passed the check
+        path[i:(i + done), idx[support]] = coefs[:done]
+        if done > 0:
+            nonzero = np.where(coefs[done - 1] != 0)[0]
+            start = (alphas[i + done - 1], idx[support[nonzero]], coefs[done - 1, nonzero])
+            grad_prev, alpha_prev = grad[:, done - 1], alphas[i + done - 1]
+        i += done
+        if i < len(alphas):
+            keep |= np.abs(grad_prev) >= 2 * alphas[i] - alpha_prev
+            if len(bad) > 0:
+                keep |= violations[:, done]
+    return path
+
+
+# `LassoCV().fit(X, y)` with the sequential strong rule: the same penalty grid and folds, every path computed by
+# `strong_rule_path` (with the predictors `working` in every working set). Returns the coefficients at the selected
+# penalty and the penalty
+def strong_rule_lasso_cv(X, y, cv=5, n_alphas=100, eps=1e-3, working=None):
+    n = len(y)
+    X_centered, y_centered = X - np.mean(X, axis=0), y - np.mean(y)
+    alpha_max = np.max(np.abs(X_centered.T @ y_centered)) / n
+    alphas = np.logspace(np.log10(alpha_max * eps), np.log10(alpha_max), num=n_alphas)[::-1]
+    mse = np.zeros(n_alphas)
+    for test in np.array_split(np.arange(n), cv):
+        train = np.setdiff1d(np.arange(n), test)
+        X_mean, y_mean = np.mean(X[train], axis=0), np.mean(y[train])
+        coefs = strong_rule_path(X[train] - X_mean, y[train] - y_mean, alphas, working)
+        residuals = (y[test] - y_mean)[:, None] - (X[test] - X_mean) @ coefs.T
+        mse += np.mean(residuals ** 2, axis=0) / cv
+    alpha_idx = np.argmin(mse)
+    return strong_rule_path(X_centered, y_centered, alphas[:alpha_idx + 1], working)[-1], alphas[alpha_idx]
+
+
+# Nodewise CV-Lasso of column `y_idx` of `X_obs` on all other columns, i.e. the estimated Markov blanket of `y_idx`.
+# When CV-Lasso selects at most one variable, the point of the Lasso path whose support is closest to
+# `target_support` (n/2 by default) is used.
+# With `screen="strong"`, CV-Lasso (over the grid of `LassoCV`, down to `eps` times the largest penalty) uses the
+# sequential strong rule with KKT checks (`strong_rule_lasso_cv`), which gives the Lasso fit on all predictors. With
+# `screen="sis"`, the `screen_size` (n by default) predictors of `sis_predictors` are kept: CV-Lasso only sees them,
+# unless `kkt_check`, in which case they seed the working sets of `strong_rule_lasso_cv`, whose KKT checks make the
+# fit exact again. The Gram matrix of `X_obs` (`gram`, e.g. `GramLasso(X_obs).gram`) can be shared across nodes for
+# SIS, otherwise its needed entries are computed. Returns the indices (in `X_obs`) of the selected variables, their
+# coefficients and the Lasso penalty
+def nodewise_lasso(y_idx, X_obs, target_support=None, screen=None, screen_size=None, eps=1e-3, kkt_check=False,
+                   gram=None):
+    # response and design matrix for Lasso
+    y = X_obs[:, y_idx]
+    n = len(y)
+    predictors = np.delete(np.arange(X_obs.shape[1]), y_idx)
+    working = None
+    if screen == "sis":
+        if gram is None:
+            X_centered = X_obs - np.mean(X_obs, axis=0)
+            c, d = X_centered.T @ X_centered[:, y_idx] / n, np.sum(X_centered ** 2, axis=0) / n
+        else:
+            c, d = gram[:, y_idx], np.diag(gram)
+        screened = sis_predictors(c, d, y_idx, n if screen_size is None else screen_size)
+        if kkt_check:
+            working = np.searchsorted(predictors, screened)  # positions among the predictors
+        else:
+            predictors = screened
+    elif screen not in (None, "strong"):
+        raise ValueError("unknown screening rule: " + str(screen))
+    X = X_obs[:, predictors]
+
+    # fit CV-lasso
+    with warnings.catch_warnings():  # ignore the convergence warnings from 'enet_path'
+        warnings.simplefilter("ignore")
+        if screen == "strong" or working is not None:
+            beta_final, alpha = strong_rule_lasso_cv(X, y, eps=eps, working=working)
+        else:
+            lasso_cv = LassoCV(eps=eps).fit(X, y)
+            beta_final = lasso_cv.coef_
+            alpha = lasso_cv.alpha_
+        if np.sum(beta_final != 0) <= 1:  # in this case return n/2 variables
+            beta_final, alpha = lasso_target_support(X, y, n / 2 if target_support is None else target_support)
+
+    # for non-zero idx, find the original indices in X_obs
+    nonzero = np.nonzero(beta_final)[0]
+    return predictors[nonzero], beta_final[nonzero], alpha
+
+
+# Nodewise regression of column `y_idx` for `estimate_precision_matrix`: the non-zeros of column `y_idx` of the
+# precision matrix, -beta / sigma2 off the diagonal and 1 / sigma2 on it, sigma2 being the residual variance
+def _precision_column(y_idx, X_obs, fit):
+    selected_idx, coef, _ = fit(y_idx, X_obs)
+    X_centered = X_obs[:, np.append(selected_idx, y_idx)] - np.mean(X_obs[:, np.append(selected_idx, y_idx)], axis=0)
+    sigma2 = np.mean((X_centered[:, -1] - X_centered[:, :-1] @ coef) ** 2)
+    return np.append(selected_idx, y_idx), np.append(-coef, 1) / sigma2
+
+
+def _graphical_lasso(corr, alpha):
+    with warnings.catch_warnings():  # ignore the convergence warnings from 'graphical_lasso'
+        warnings.simplefilter("ignore")
+        return graphical_lasso(corr, alpha)
+
+
+# Sparse estimate (scipy CSC matrix) of the precision matrix of `X_obs`, whose non-zeros give the Markov blankets of
+# all variables at once, e.g. for the `Precision_mat` of `root_cause_discovery_highdim_parallel`.
+# "glasso": graphical lasso with penalty `alpha` (sqrt(log(p) / n) by default) on the correlation matrix. The connected
+# components of the graph |corr_ij| > alpha are the diagonal blocks of the solution, so each component is solved
+# separately (on `n_jobs` cores) and isolated variables need no fit.
+# "nodewise": one `fit(y_idx, X_obs)` per variable (`nodewise_lasso` by default) on `n_jobs` cores, the two estimates
+# of each entry being averaged; an entry is non-zero when either regression selects it
+def estimate_precision_matrix(X_obs, method="glasso", alpha=None, n_jobs=1, fit=nodewise_lasso):
+    n, p = X_obs.shape
+    if method == "glasso":
+        if alpha is None:
+            alpha = np.sqrt(np.log(p) / n)
+        scale = np.std(X_obs, axis=0)
+        corr = np.corrcoef(X_obs, rowvar=False)
+        n_components, labels = connected_components(sparse.csr_matrix(np.abs(corr) > alpha), directed=False)
+        blocks = [np.where(labels == k)[0] for k in range(n_components)]
+        large = [block for block in blocks if len(block) > 1]
+        fits = Parallel(n_jobs=n_jobs)(delayed(_graphical_lasso)(corr[np.ix_(block, block)], alpha) for block in large)
+        rows, cols, values = [], [], []
+        for block in blocks:
+            if len(block) == 1:
+                rows.append(block)
+                cols.append(block)
+                values.append(np.ones(1))
+        for block, (_, precision) in zip(large, fits):
+            rows.append(np.repeat(block, len(block)))
+            cols.append(np.tile(block, len(block)))
+            values.append(precision.ravel())
+        rows, cols, values = np.concatenate(rows), np.concatenate(cols), np.concatenate(values)
+        values = values / (scale[rows] * scale[cols])  # back to the scale of X_obs
+    elif method == "nodewise":
+        columns = Parallel(n_jobs=n_jobs)(delayed(_precision_column)(y_idx, X_obs, fit) for y_idx in range(p))
+        rows = np.concatenate([idx for idx, _ in columns])
+        cols = np.concatenate([np.repeat(y_idx, len(idx)) for y_idx, (idx, _) in enumerate(columns)])
+        values = np.concatenate([value for _, value in columns])
+        # average theta_ij and theta_ji, counting a missing one as 0
+        rows, cols = np.concatenate([rows, cols]), np.concatenate([cols, rows])
+        values = np.concatenate([values, values]) / 2
+    else:
+        raise ValueError("unknown precision matrix estimator: " + str(method))
+    precision = sparse.csc_matrix((values, (rows, cols)), shape=(p, p))  # duplicate entries are summed
+    precision.eliminate_zeros()
+    return precision
+
+
+# JSON description of a nodewise Lasso `fit(y_idx, X_obs)`, i.e. of what its fits depend on besides the data: the
+# engine and its parameters, for `nodewise_lasso` (or a `functools.partial` of it) and `GramLasso`
+def describe_fit(fit):
+    if isinstance(fit, GramLasso):
+        return {"engine": "gram", "cv": len(fit.folds), "n_alphas": fit.n_alphas, "eps": fit.eps,
+                "target_support": fit.target_support}
+    keywords = {}
+    while isinstance(fit, partial):
+        keywords = {**fit.keywords, **keywords}
+        fit = fit.func
+    keywords.pop("gram", None)  # the Gram matrix of the data, only used for screening
+    return json.loads(json.dumps({"engine": getattr(fit, "__name__", type(fit).__name__), **keywords}, default=str))
+
+
+# Persistent index y_idx -> (selected_idx, coefficients, alpha) of the nodewise Lasso fits of one observational cohort.
+# The fits only depend on `X_obs`, so each one is computed on demand, once, and re-used for every patient.
+# With a `path`, every fit is stored in `<path>/mb_<y_idx>.npz` (written atomically, so that parallel workers can fill
+# the same index), the cohort's fingerprint in `<path>/cohort.json` and the description of the Lasso that computed the
+# fits (see `describe_fit`) in `<path>/fit.json`; using the index with another cohort or another Lasso raises a
+# ValueError. Without a `path`, fits only live in memory, so fits computed in other processes are not kept
+class MarkovBlanketIndex:
+    def __init__(self, path=None, X_obs=None):
+        self.path = path
+        self._cohort = None
+        self._fit = None
+        self._fits = {}
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+        if X_obs is not None:
+            self.check_cohort(X_obs)
+
+    # record the fingerprint of `X_obs`, or check it against the recorded one
+    def check_cohort(self, X_obs):
+        X_obs = np.ascontiguousarray(X_obs)
+        cohort = {"shape": list(X_obs.shape), "sha1": hashlib.sha1(X_obs).hexdigest()}
+        recorded = self._cohort
+        if self.path is not None:
+            cohort_file = os.path.join(self.path, "cohort.json")
+            if os.path.exists(cohort_file):
+                with open(cohort_file) as io:
+                    recorded = json.load(io)
+        if recorded is None:
+            self._cohort = cohort
+            if self.path is not None:
+                self._write(os.path.join(self.path, "cohort.json"), lambda io: io.write(json.dumps(cohort).encode()))
+        elif recorded != cohort:
+            raise ValueError("the Markov blanket index was built from a different observational cohort")
+
+    # record the description of the Lasso `fit`, or check it against the recorded one
+    def check_fit(self, fit):
+        description = describe_fit(fit)
+        recorded = self._fit
+        if self.path is not None:
+            fit_file = os.path.join(self.path, "fit.json")
+            if os.path.exists(fit_file):
+                with open(fit_file) as io:
+                    recorded = json.load(io)
+        if recorded is None:
+            if self.path is not None:
+                self._write(os.path.join(self.path, "fit.json"), lambda io: io.write(json.dumps(description).encode()))
+        elif recorded != description:
+            raise ValueError("the Markov blanket index was built with another Lasso: " + json.dumps(recorded))
+        self._fit = description
+
+    def _fit_file(self, y_idx):
+        return os.path.join(self.path, "mb_" + str(y_idx) + ".npz")
+
+    # write a file through a temporary file and an atomic rename
+    def _write(self, filename, write):
+        tmp = filename + ".tmp" + str(os.getpid())
+        with open(tmp, "wb") as io:
+            write(io)
+        os.replace(tmp, filename)
+
+    def __contains__(self, y_idx):
+        y_idx = int(y_idx)
+        return y_idx in self._fits or (self.path is not None and os.path.exists(self._fit_file(y_idx)))
+
+    # number of selected variables of `y_idx`, or None if it is not in the index yet
+    def blanket_size(self, y_idx):
+        y_idx = int(y_idx)
+        if y_idx in self._fits:
+            return len(self._fits[y_idx][0])
+        if self.path is not None and os.path.exists(self._fit_file(y_idx)):
+            return len(np.load(self._fit_file(y_idx))["selected_idx"])
+        return None
+
+    # (selected_idx, coefficients, alpha) of `y_idx`, computed by `fit(y_idx, X_obs)` if not in the index yet
+    def get(self, y_idx, X_obs, fit=nodewise_lasso):
+        if self._fit != describe_fit(fit):
+            self.check_fit(fit)
+        y_idx = int(y_idx)
+        if y_idx in self._fits:
+            return self._fits[y_idx]
+        if self.path is not None and os.path.exists(self._fit_file(y_idx)):
+            data = np.load(self._fit_file(y_idx))
+            result = data["selected_idx"], data["coef"], float(data["alpha"])
+        else:
+            result = fit(y_idx, X_obs)
+            if self.path is not None:
+                selected_idx, coef, alpha = result
+                self._write(self._fit_file(y_idx),
+                            lambda io: np.savez(io, selected_idx=selected_idx, coef=coef, alpha=alpha))
+        self._fits[y_idx] = result
+        return result
+
+
+# Columns of the centered Gram matrix X^T X / n of `X_obs`, or of its training part when the rows `test` are held out.
+# The full Gram matrix is computed once; columns of a training Gram matrix are derived from it with a low-rank
+# correction by the held-out rows, so the design matrix is never copied. With `centered=False` (no `test`), the
+# columns are those of the uncentered X^T X / n, the Gram matrix of a Lasso without intercept
+class _GramView:
+    def __init__(self, X_obs, gram, mean, test=None, centered=True):
+        n = X_obs.shape[0]
+        self.centered = centered
+        self.gram, self.full_mean, self.n_full = gram, mean, n
+        if test is None:
+            self.n, self.mean, self.X_test = n, mean, None
+        else:
+            self.X_test = X_obs[test]
+            self.n = n - len(test)
+            self.mean = (n * mean - np.sum(self.X_test, axis=0)) / self.n
+        self._cache = {}
+
+    # Gram matrix columns `idx` (p x len(idx))
+    def cols(self, idx):
+        if self.X_test is None:
+            return self.gram[:, idx] if self.centered else self.gram[:, idx] + np.outer(self.mean, self.mean[idx])
+        missing = [k for k in idx if k not in self._cache]
+        if len(missing) > 0:
+            new = (self.n_full * (self.gram[:, missing] + np.outer(self.full_mean, self.full_mean[missing]))
+                   - self.X_test.T @ self.X_test[:, missing]
+                   - self.n * np.outer(self.mean, self.mean[missing])) / self.n
+            for i, k in enumerate(missing):
+                self._cache[k] = new[:, i]
+        return np.column_stack([self._cache[k] for k in idx]) if len(idx) > 0 else np.zeros((len(self.mean), 0))
+
+    def clear(self):
+        self._cache = {}
+
+
+# Knots of the Lasso path of a response on p variables by the LARS-Lasso homotopy, in covariance form: `c` holds the
+# correlations X^T y / n of the variables with the response and `cols(k)` returns column k of the Gram matrix
+# X^T X / n, so only the columns of the variables that become active are needed. The path goes from the largest penalty
+# down to `alpha_min`, or until `max_active` variables are active; once the active set has `rank` variables (the rank
+# of the design), no variable can join it but the path goes on. Variables `exclude` never join. The path starts at the
+# largest penalty, or continues from a point `start` = (penalty, active variables, their coefficients) of the path.
+# Returns the penalty, active set and coefficients at each knot
+def lasso_knots(c, cols, rank, alpha_min=0.0, max_active=None, exclude=None, start=None):
+    c = np.array(c, dtype=float)
+    candidate = np.ones(len(c), dtype=bool)
+    if exclude is not None:
+        c[exclude], candidate[exclude] = 0, False
+    alpha = np.max(np.abs(c), initial=0)
+    active, beta = [], np.zeros(0)
+    if max_active is not None and max_active >= rank:
+        max_active = None  # the path is needed down to alpha_min
+    # Gram columns of the active variables, in the order of `active`, in the first len(active) columns
+    G_buffer = np.empty((len(c), rank + 1), order="F")
+    if start is not None and len(start[1]) > 0:  # a point without active variables is on the top of the path
+        alpha, active, beta = start[0], [int(k) for k in start[1]], np.array(start[2], dtype=float)
+        candidate[active] = False
+        for i, k in enumerate(active):
+            G_buffer[:, i] = cols(k)
+    knots = [(alpha, list(active), beta)]
+    while alpha > alpha_min:
+        if len(active) == 0:
+            if not np.any(candidate):
+                break
+            k = int(np.argmax(np.where(candidate, np.abs(c), -1)))
+            active, beta = [k], np.zeros(1)
+            candidate[k] = False
+            G_buffer[:, 0] = cols(k)
+        G_A = G_buffer[:, :len(active)]
+        r = c - G_A @ beta
+        try:
+            d = np.linalg.solve(G_A[active], np.sign(r[active]))
+        except np.linalg.LinAlgError:
+            break
+        a = G_A @ d
+        tiny = 1e-12 * alpha
+        # step at which an inactive variable joins, i.e. |r_k - gamma * a_k| = alpha - gamma
+        with np.errstate(divide="ignore", invalid="ignore"):
+            join = np.fmin(np.where((alpha - r) / (1 - a) > tiny, (alpha - r) / (1 - a), np.inf),
+                           np.where((alpha + r) / (1 + a) > tiny, (alpha + r) / (1 + a), np.inf))
+            drop = np.where(-beta / d > tiny, -beta / d, np.inf)
+        join[~candidate] = np.inf
+        if len(active) >= rank:
+            join[:] = np.inf
+        gamma_join, gamma_drop = np.min(join), np.min(drop)
+        gamma = min(gamma_join, gamma_drop, alpha - alpha_min)
+        beta = beta + gamma * d
+        alpha = alpha - gamma
+        if gamma == gamma_drop:
+            i = int(np.argmin(drop))
+            candidate[active[i]] = True
+            # the last active variable takes the place of the dropped one
+            active[i], beta[i], G_buffer[:, i] = active[-1], beta[-1], G_buffer[:, len(active) - 1]
+            active, beta = active[:-1], beta[:-1]
+        elif gamma == gamma_join:
+            k = int(np.argmin(join))
+            G_buffer[:, len(active)] = cols(k)
+            active.append(k)
+            beta = np.append(beta, 0.0)
+            candidate[k] = False
+        knots.append((alpha, list(active), beta.copy()))
+        if max_active is not None and len(active) >= max_active:
+            break
+    return knots
+
+
+# coefficients of the path given by `knots` at the (descending) penalties `alphas`, on the variables `support`.
+# The path is piecewise linear between knots and constant below the last knot
+def interpolate_knots(knots, alphas):
+    support = np.unique(np.concatenate([np.array(active, dtype=int) for _, active, _ in knots]))
+    pos = {k: i for i, k in enumerate(support)}
+    knot_alphas = np.array([knot[0] for knot in knots])
+    knot_betas = np.zeros((len(knots), len(support)))
+    for i, (_, active, beta) in enumerate(knots):
+        knot_betas[i, [pos[k] for k in active]] = beta
+    coefs = np.zeros((len(alphas), len(support)))
+    for i, alpha in enumerate(alphas):
+        if alpha >= knot_alphas[0]:
+            continue
+        k = np.searchsorted(-knot_alphas, -alpha)  # first knot with knot_alphas[k] <= alpha
+        if k == len(knots):
+            coefs[i] = knot_betas[-1]
+        else:
+            t = (knot_alphas[k - 1] - alpha) / (knot_alphas[k - 1] - knot_alphas[k])
+            coefs[i] = (1 - t) * knot_betas[k - 1] + t * knot_betas[k]
+    return support, coefs
+
+
+# Nodewise Lasso engine in covariance (Gram) form. The Gram matrix of `X_obs` is computed once and every node's Lasso
+# path is computed from slices of it with the LARS-Lasso homotopy, whose steps cost O(p * active) instead of O(n * p).
+# `GramLasso(X_obs)(y_idx)` computes the fit of `nodewise_lasso(y_idx, X_obs)`: `cv`-fold CV over `n_alphas` penalties
+# down to `eps` times the largest one (the grid of `LassoCV`), and the fallback to `target_support` (n/2 by default)
+# variables when at most one variable is selected. Its paths are exact, while `LassoCV` solves each penalty by
+# coordinate descent up to a tolerance, so where two penalties have nearly the same CV error the two can select
+# neighbouring penalties of the grid
+class GramLasso:
+    def __init__(self, X_obs, cv=5, n_alphas=100, eps=1e-3, target_support=None):
+        self.X_obs = X_obs
+        self.n, self.p = X_obs.shape
+        self.n_alphas, self.eps = n_alphas, eps
+        self.target_support = self.n / 2 if target_support is None else target_support
+        mean = np.mean(X_obs, axis=0)
+        X_centered = X_obs - mean
+        self.gram = X_centered.T @ X_centered / self.n
+        self.full = _GramView(X_obs, self.gram, mean)
+        self.uncentered = _GramView(X_obs, self.gram, mean, centered=False)  # for the fallback, see `__call__`
+        self.folds = [_GramView(X_obs, self.gram, mean, test) for test in np.array_split(np.arange(self.n), cv)]
+
+    # Knots of the Lasso path of column `y_idx` on all other columns in `view`, see `lasso_knots`
+    def lasso_knots(self, y_idx, view, alpha_min=0.0, max_active=None):
+        rank = min(view.n - 1 if view.centered else view.n, self.p - 1)  # rank of the design
+        return lasso_knots(view.cols([y_idx])[:, 0], lambda k: view.cols([k])[:, 0], rank, alpha_min, max_active,
+                           exclude=y_idx)
+
+    # penalty grid of `LassoCV` for column `y_idx`, or of `lasso_target_support` with `view=self.uncentered`
+    def alphas(self, y_idx, view=None):
+        gram_column = self.gram[:, y_idx] if view is None else view.cols([y_idx])[:, 0]
+        alpha_max = np.max(np.abs(np.delete(gram_column, y_idx)))
+        return np.logspace(np.log10(alpha_max * self.eps), np.log10(alpha_max), num=self.n_alphas)[::-1]
+
+    # same output as `nodewise_lasso(y_idx, X_obs)`: selected indices, their coefficients and the penalty
+    def __call__(self, y_idx, X_obs=None):
+        alphas = self.alphas(y_idx)
+        # mean squared error of every penalty on every held-out fold
+        mse = np.zeros(len(alphas))
+        for fold in self.folds:
+            support, coefs = interpolate_knots(self.lasso_knots(y_idx, fold, alphas[-1]), alphas)
+            X_test = fold.X_test[:, support] - fold.mean[support]
+            residuals = (fold.X_test[:, y_idx] - fold.mean[y_idx])[:, None] - X_test @ coefs.T
+            mse += np.mean(residuals ** 2, axis=0) / len(self.folds)
+            fold.clear()
+        alpha = alphas[np.argmin(mse)]
+        support, coefs = interpolate_knots(self.lasso_knots(y_idx, self.full, alpha), [alpha])
+        beta_final = coefs[0]
+        if np.sum(beta_final != 0) <= 1:  # in this case return n/2 variables
+            # as `lasso_target_support`, which fits the Lasso without intercept on the uncentered data and its grid.
+            # The path is only needed down to the first penalty of the grid where the support reaches its target size
+            alphas = self.alphas(y_idx, self.uncentered)
+            knots = self.lasso_knots(y_idx, self.uncentered, alphas[-1], int(np.ceil(self.target_support)))
+            alpha_min = alphas[min(np.searchsorted(-alphas, -knots[-1][0], side="right"), len(alphas) - 1)]
+            knots = self.lasso_knots(y_idx, self.uncentered, alpha_min)
+            alphas = alphas[alphas >= alpha_min]
+            support, coefs = interpolate_knots(knots, alphas)
+            num_nonzeros = np.sum(coefs != 0, axis=1)
+            alpha_idx = np.argmin(np.abs(num_nonzeros - self.target_support))
+            alpha, beta_final = alphas[alpha_idx], coefs[alpha_idx]
+        nonzero = np.nonzero(beta_final)[0]
+        return support[nonzero], beta_final[nonzero], alpha
@@ -0,0 +1,183 @@
+import os
+import sys
+import json
+import time
+import copy
+import shutil
+import tempfile
+import numpy as np
+from scipy import sparse
+from joblib import effective_n_jobs
+from threadpoolctl import threadpool_limits
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+# free space needed to put the shared arrays in /dev/shm, as joblib's SYSTEM_SHARED_MEM_FS_MIN_SIZE: containers often
+# mount a small /dev/shm (e.g. 64 MB with Docker), which a large array would fill
+SHARED_MEM_MIN_FREE = int(2e9)
+
+
+# whether `value` is an object of a class defined in this package (imported as `funcs.*` or as flat modules)
+def _in_this_package(value):
+    module = sys.modules.get(type(value).__module__)
+    filename = getattr(module, "__file__", None)
+    here = os.path.dirname(os.path.abspath(__file__))
+    return filename is not None and os.path.dirname(os.path.abspath(filename)) == here
+
+
+# Read-only arrays shared by the workers of a joblib `Parallel` call. Every array is written once to a `.npy` file in
+# a temporary folder (in /dev/shm, i.e. in shared memory, when it exists and has `SHARED_MEM_MIN_FREE` bytes free,
+# otherwise in the default temporary directory) and re-opened memory-mapped. An array that does not fit in the free
+# space left in /dev/shm is written again in the default temporary directory, as are the arrays shared after it.
+# joblib pickles memory-mapped arrays as a file name, so each task only sends the file names and all workers read the
+# same pages. Use as a context manager, the folders are removed on exit
+class SharedArrays:
+    def __init__(self, folder=None, min_bytes=1024 ** 2):
+        if folder is None:
+            if os.path.isdir("/dev/shm") and shutil.disk_usage("/dev/shm").free >= SHARED_MEM_MIN_FREE:
+                folder = "/dev/shm"
+            else:
+                folder = tempfile.gettempdir()
+        self.folder = tempfile.mkdtemp(prefix="rcd_shared_", dir=folder)
+        self._folders = [self.folder]
+        self.min_bytes = min_bytes  # smaller arrays are pickled as usual
+        self.nbytes = 0
+        self._memo = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for folder in self._folders:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    def _share_array(self, array):
+        filename = os.path.join(self.folder, "array" + str(len(self._memo)) + ".npy")
+        try:
+            np.save(filename, array)
+        except OSError:  # e.g. ENOSPC in a full /dev/shm
+            if os.path.exists(filename):
+                os.remove(filename)
+            fallback = tempfile.gettempdir()
+            if os.path.dirname(self.folder) == fallback:
+                raise
+            self.folder = tempfile.mkdtemp(prefix="rcd_shared_", dir=fallback)
+            self._folders.append(self.folder)
+            filename = os.path.join(self.folder, os.path.basename(filename))
+            np.save(filename, array)
+        self.nbytes += array.nbytes
+        return np.load(filename, mmap_mode="r")
+
+    # `value` with its arrays replaced by read-only memory-mapped copies: arrays, the arrays of scipy sparse matrices,
+    # and recursively the items of tuples and lists and the attributes of the objects of this package (e.g. a
+    # `GramLasso` or an `ObservationalReference`, which are copied). An array shared twice is written once
+    def share(self, value):
+        if id(value) in self._memo:
+            return self._memo[id(value)][1]
+        if isinstance(value, np.memmap) or value is None:
+            shared = value
+        elif isinstance(value, np.ndarray):
+            shared = self._share_array(value) if value.nbytes >= self.min_bytes else value
+        elif sparse.issparse(value):
+            value = value.tocsc()
+            shared = sparse.csc_matrix((self.share(value.data), self.share(value.indices), self.share(value.indptr)),
+                                       shape=value.shape, copy=False)
+        elif isinstance(value, (tuple, list)):
+            shared = type(value)(self.share(item) for item in value)
+        elif hasattr(value, "__dict__") and _in_this_package(value):
+            shared = copy.copy(value)
+            shared.__dict__ = {key: self.share(item) for key, item in value.__dict__.items()}
+        else:
+            shared = value
+        self._memo[id(value)] = (value, shared)  # keeps `value` alive, so that its id is not re-used
+        return shared
+
+
+# Append-only JSON-lines store of the per-y_idx results of a run, to checkpoint it and resume it after an interruption.
+# The first line is a header with the `meta` data of the run (anything JSON can represent); opening an existing store
+# with other `meta` data raises a ValueError. `records` maps each stored y_idx to its record. A last line cut by an
+# interrupted write is dropped. Every record is flushed when appended, so that it survives the end of the process
+class CheckpointStore:
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = json.loads(json.dumps(meta))  # as read back from the file
+        self.records = {}
+        content = b""
+        if os.path.exists(path):
+            with open(path, "rb") as io:
+                content = io.read()
+        end = content.rfind(b"\n") + 1
+        if end < len(content):  # truncated last line
+            with open(path, "r+b") as io:
+                io.truncate(end)
+        lines = content[:end].decode().splitlines()
+        if len(lines) > 0 and json.loads(lines[0]).get("meta") != self.meta:
+            raise ValueError("the checkpoint " + path + " was written by a different run")
+        for line in lines[1:]:
+            record = json.loads(line)
+            self.records[record["y_idx"]] = record
+        self._io = open(path, "a")
+        if len(lines) == 0:
+            self._write({"meta": self.meta})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, y_idx):
+        return int(y_idx) in self.records
+
+    def _write(self, record):
+        self._io.write(json.dumps(record) + "\n")
+        self._io.flush()
+
+    def append(self, record):
+        self._write(record)
+        self.records[record["y_idx"]] = record
+
+    def close(self):
+        self._io.close()
+
+
+# peak resident memory of the current process in bytes, or None where it cannot be measured
+def peak_memory():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024  # kilobytes on Linux
+
+
+# Split of the `n_jobs` cores into worker processes and BLAS/OpenMP threads per process, for `n_tasks` tasks on `p`
+# variables. `n_jobs` counts cores as in joblib (`effective_n_jobs`): None is 1 unless set by `parallel_config`, -1 is
+# all cores, -2 all but one, etc. `policy` is a pair (processes, threads per process) or "auto": one single-threaded
+# process per core as long as there are more tasks than cores; with fewer tasks, the spare cores go to the threads of
+# each process when the tasks are large enough (p >= `min_threaded_p`) for multithreaded linear algebra to pay off
+def resolve_execution_policy(policy, n_jobs, p, n_tasks, min_threaded_p=1000):
+    if policy != "auto":
+        processes, threads = policy
+        return int(processes), int(threads)
+    cores = effective_n_jobs(n_jobs)
+    processes = max(1, min(cores, n_tasks))
+    threads = max(1, cores // processes) if p >= min_threaded_p else 1
+    return processes, threads
+
+
+# `func(*args)` in a worker, with at most `threads` BLAS/OpenMP threads if given, returned with the id and the peak
+# resident memory of the worker process and the time it took (seconds)
+def run_with_memory(func, *args, threads=None):
+    start = time.perf_counter()
+    if threads is None:
+        result = func(*args)
+    else:
+        with threadpool_limits(limits=threads):
+            result = func(*args)
+    return result, os.getpid(), peak_memory(), time.perf_counter() - start
@@ -1,100 +1,407 @@
+import os
 import numpy as np
-import random
+import json
+import hashlib
+import heapq
+import warnings
+from functools import partial
+from collections import OrderedDict
 from numpy import linalg as LA
-from sklearn.linear_model import LassoCV, lasso_path
-import warnings  # ignore the warnings
-from sklearn.covariance import ShrunkCovariance
+from sklearn.covariance import ShrunkCovariance, shrunk_covariance
+from scipy.linalg import solve_triangular, lapack
 from joblib import Parallel, delayed
 from tqdm import tqdm
+from scipy import sparse
+try:
+    from funcs.markov_blanket_funcs import (nodewise_lasso, MarkovBlanketIndex, GramLasso, estimate_precision_matrix,
+                                            describe_fit)
+    from funcs.parallel_funcs import SharedArrays, CheckpointStore, run_with_memory, resolve_execution_policy
+except ImportError:  # imported as a flat module, with python/funcs itself on the path
+    from markov_blanket_funcs import (nodewise_lasso, MarkovBlanketIndex, GramLasso, estimate_precision_matrix,
+                                      describe_fit)
+    from parallel_funcs import SharedArrays, CheckpointStore, run_with_memory, resolve_execution_policy
 
 
 # generate thresholds to determine aberrant set, make sure no repeated permutations later.
-def get_aberrant_thresholds(z_vec, thre_min=0.1, thre_max=5, thre_seq=0.2):
-    thresholds_raw = np.arange(thre_min, thre_max, thre_seq)
-    thre_new = list()
-    count_temp = -1
-    for threshold in thresholds_raw:
-        if np.sum(z_vec >= threshold) > 0:
-            if np.sum(z_vec <= threshold) != count_temp:
-                count_temp = np.sum(z_vec <= threshold)
-                thre_new.append(threshold)
-    thre_new = np.array(thre_new)
+# The counts of z scores above/below each threshold come from one sort and `searchsorted`, so this is O(p log p).
+# With `grid="data"` the thresholds are `thre_min` and the distinct z scores in [thre_min, thre_max) instead of the
+# regular grid, so every threshold gives a different aberrant set. `max_levels` caps the number of thresholds (evenly
+# spaced among the candidates), which bounds the number of aberrant sets and hence the downstream work
+def get_aberrant_thresholds(z_vec, thre_min=0.1, thre_max=5, thre_seq=0.2, grid="fixed", max_levels=None):
+    z_sorted = np.sort(z_vec)
+    if grid == "fixed":
+        thresholds_raw = np.arange(thre_min, thre_max, thre_seq)
+    elif grid == "data":
+        z_in_range = z_sorted[(z_sorted >= thre_min) & (z_sorted < thre_max)]
+        thresholds_raw = np.unique(np.append(z_in_range, thre_min))
+    else:
+        raise ValueError("grid should be 'fixed' or 'data'")
+    # number of z scores >= and <= each threshold
+    count_above = len(z_sorted) - np.searchsorted(z_sorted, thresholds_raw, side="left")
+    count_below = np.searchsorted(z_sorted, thresholds_raw, side="right")
+    if grid == "data":
+        # keep at least one z score strictly above the threshold
+        count_above = len(z_sorted) - count_below
+    thresholds_raw, count_below = thresholds_raw[count_above > 0], count_below[count_above > 0]
+    # keep the first threshold of each distinct aberrant set
+    keep = np.ones(len(thresholds_raw), dtype=bool)
+    keep[1:] = count_below[1:] != count_below[:-1]
+    thre_new = thresholds_raw[keep]
+    if max_levels is not None and len(thre_new) > max_levels:
+        thre_new = thre_new[np.unique(np.round(np.linspace(0, len(thre_new) - 1, max_levels)).astype(int))]
     return thre_new
 
 
-# `X_obs` and `X_int` are matrices
-def zscore(X_obs, X_int):
+# `X_obs` and `X_int` are matrices. Instead of `X_obs`, its mean `mu` and sample std `sigma` can be given.
+# The squared z scores are written to `out` if given, otherwise to a new array of type `dtype` (e.g. np.float32)
+def zscore(X_obs, X_int, mu=None, sigma=None, out=None, dtype=np.float64):
     if X_int.ndim == 1:
-        return zscore_vec(X_obs, X_int)
+        return zscore_vec(X_obs, X_int, mu, sigma, out, dtype)
     n, p = X_int.shape
-    assert X_obs.shape[1] == p, "Both inputs should have same number of variables"
-    # observational data's mean and std
-    mu = np.mean(X_obs, axis=0)
-    sigma = np.std(X_obs, axis=0, ddof=1)  # sample std
-    # compute squared Z scores for each patient in interventional data
-    zscore_intv = np.zeros((n, p))
-    for i in range(n):
-        zs = [(abs((X_int[i, j] - mu[j]) / sigma[j])) ** 2 for j in range(p)]
-        zscore_intv[i, :] = zs
-    return zscore_intv
+    mu, sigma = _mean_std(X_obs, mu, sigma)
+    assert len(mu) == p, "Both inputs should have same number of variables"
+    return _squared_zscore(X_int, mu, sigma, out, dtype)
 
 
 # `X_obs` is matrix, `X_int` is a vector
-def zscore_vec(X_obs, X_int):
+def zscore_vec(X_obs, X_int, mu=None, sigma=None, out=None, dtype=np.float64):
     ngenes = len(X_int)
-    assert X_obs.shape[1] == ngenes, "Number of genes mismatch"
-    # observational data's mean and std
-    mu = np.mean(X_obs, axis=0)
-    sigma = np.std(X_obs, axis=0, ddof=1)
-    # compute squared Z scores for each patient in interventional data
-    zs = np.array([(abs((X_int[i] - mu[i]) / sigma[i])) ** 2 for i in range(ngenes)])
-    return zs
-
-
-# `z` is a vector
-def compute_permutations(z, threshold=1.5, nshuffles=5):
+    mu, sigma = _mean_std(X_obs, mu, sigma)
+    assert len(mu) == ngenes, "Number of genes mismatch"
+    return _squared_zscore(X_int, mu, sigma, out, dtype)
+
+
+# observational data's mean and std, unless they are given. `X_obs` can also be an `ObservationalReference`
+def _mean_std(X_obs, mu=None, sigma=None):
+    if isinstance(X_obs, ObservationalReference):
+        mu = X_obs.mean if mu is None else mu
+        sigma = X_obs.std if sigma is None else sigma
+    if mu is None:
+        mu = np.mean(X_obs, axis=0)
+    if sigma is None:
+        sigma = np.std(X_obs, axis=0, ddof=1)  # sample std
+    return mu, sigma
+
+
+# squared Z scores ((X_int - mu) / sigma)^2, broadcast over the rows of `X_int` in a single pass over `out`
+def _squared_zscore(X_int, mu, sigma, out=None, dtype=np.float64):
+    if out is None:
+        out = np.empty(np.shape(X_int), dtype=dtype)
+    assert out.shape == np.shape(X_int), "out has the wrong shape"
+    np.subtract(X_int, np.asarray(mu, dtype=out.dtype), out=out)
+    np.divide(out, np.asarray(sigma, dtype=out.dtype), out=out)
+    np.square(out, out=out)
+    return out
+
+
+# `np.random.Generator` from `seed`: an int, a Generator, or None to draw the seed from numpy's global random state
+# (so that `np.random.seed` keeps results reproducible)
+def _random_generator(seed=None):
+    if isinstance(seed, np.random.Generator):
+        return seed
+    if seed is None:
+        seed = np.random.randint(np.iinfo(np.int32).max)
+    return np.random.default_rng(seed)
+
+
+# `z` is a vector. Returns a (n_perms x p) int32 matrix with one permutation per row: the normal variables
+# (z <= threshold) first, followed by the aberrant ones. Each aberrant variable is placed first among the aberrant
+# ones in `nshuffles` rows, with the other aberrant variables shuffled. With `shuffle_normal=False` the normal
+# variables stay in ascending order, so that all rows share the same normal block (see `root_cause_discovery_schur`).
+# `seed` is passed to `_random_generator`
+def compute_permutations(z, threshold=1.5, nshuffles=5, shuffle_normal=True, seed=None):
+    rng = _random_generator(seed)
+    z = np.asarray(z)
+    p = len(z)
     # subset of variables indices that are abberent
-    idx_abberent = [i for i, x in enumerate(z) if x > threshold]
-    idx_abberent_copy = idx_abberent.copy()
+    idx_abberent = np.where(z > threshold)[0].astype(np.int32)
     # subset of variables indices that are normal
-    idx_normal = list(set(range(len(z))) - set(idx_abberent))
+    idx_normal = np.setdiff1d(np.arange(p, dtype=np.int32), idx_abberent)
+    n_normal, k = len(idx_normal), len(idx_abberent)
+
     # generate feasible permutations accroding to our theoretical results
-    perms = []
-    for i in range(len(idx_abberent)):
-        for _ in range(nshuffles):
-            random.shuffle(idx_normal)
-            random.shuffle(idx_abberent)
-            target = idx_abberent_copy[i]
-            index = idx_abberent.index(target)
-            idx_abberent[0], idx_abberent[index] = idx_abberent[index], idx_abberent[0]
-            perms.append(idx_normal + idx_abberent)
+    perms = np.empty((k * nshuffles, p), dtype=np.int32)
+    if k == 0:
+        return perms
+    perms[:, :n_normal] = idx_normal
+    if shuffle_normal:
+        perms[:, :n_normal] = rng.permuted(perms[:, :n_normal], axis=1)
+    # row i of `others` holds the aberrant variables except the i-th one
+    others = np.broadcast_to(idx_abberent, (k, k))[~np.eye(k, dtype=bool)].reshape(k, k - 1)
+    perms[:, n_normal] = np.repeat(idx_abberent, nshuffles)
+    perms[:, (n_normal + 1):] = rng.permuted(np.repeat(others, nshuffles, axis=0), axis=1)
     return perms
 
 
-# Basic root cause discovery function with 'perm' as an input
-# `X_obs` is a matrix, `X_int` a vector, `perm` a permutation vector
-def root_cause_discovery(X_obs, X_int, perm):
-    if not isinstance(perm, np.ndarray):
-        perm = np.array(perm)
+# how often each path of `make_positive_definite` was taken in this process, see `pd_repair_stats`: accepted after
+# Cholesky ("cholesky") or after `eigvalsh` ("eigvalsh"), repaired with the first diagonal shift ("repaired") or with
+# more jitter ("jitter")
+_pd_repair_counts = {"cholesky": 0, "eigvalsh": 0, "repaired": 0, "jitter": 0}
+
+
+# counts of the paths taken by `make_positive_definite` since the last `reset_pd_repair_stats`. The counts of the
+# workers of `root_cause_discovery_highdim_parallel` are returned with their tasks and added to those of the caller
+def pd_repair_stats():
+    return dict(_pd_repair_counts)
+
+
+def reset_pd_repair_stats():
+    for key in _pd_repair_counts:
+        _pd_repair_counts[key] = 0
+
+
+# margin of the Cholesky fast path of `make_positive_definite`. `pocon` estimates ||sigma^{-1}||_1 from below, so
+# 1 / estimate, unlike 1 / ||sigma^{-1}||_1, can exceed the minimum eigenvalue: by up to 2.3x on random positive
+# definite matrices. The estimate is accepted only when it is `POCON_MARGIN` times above `tol`
+POCON_MARGIN = 10
+
+
+# Return a positive-definite version of the symmetric matrix `sigma` together with its Cholesky factor, with minimum
+# eigenvalue at least `tol`. Cholesky is tried first and accepted without an eigen-decomposition when the estimate of
+# 1 / ||sigma^{-1}||_1 (<= the minimum eigenvalue) by LAPACK `pocon` from the factor (O(p^2)) is at least
+# `POCON_MARGIN * tol`. This is a heuristic, not a guarantee: the estimate is not a bound, but it is far from the
+# true value only on contrived matrices. Otherwise the minimum eigenvalue is computed with `eigvalsh`, and when it is
+# below `tol`, `abs(min_eigenvalue) + tol` is added to the diagonal. If Cholesky still fails (round-off), that diagonal
+# jitter is increased ten-fold until it succeeds
+def make_positive_definite(sigma, tol=1e-6, max_tries=10):
+    try:
+        L = LA.cholesky(sigma)
+    except LA.LinAlgError:
+        L = None
+    if L is not None:
+        anorm = np.max(np.sum(np.abs(sigma), axis=0))
+        rcond, info = lapack.dpocon(L, anorm, uplo="L")
+        if info == 0 and rcond * anorm >= POCON_MARGIN * tol:
+            _pd_repair_counts["cholesky"] += 1
+            return sigma, L
+
+    min_eigenvalue = LA.eigvalsh(sigma)[0]
+    if L is not None and min_eigenvalue >= tol:
+        _pd_repair_counts["eigvalsh"] += 1
+        return sigma, L
+    jitter = abs(min_eigenvalue) + tol
+    identity = np.eye(sigma.shape[0])
+    for count in range(max_tries):
+        try:
+            L = LA.cholesky(sigma + jitter * identity)
+            _pd_repair_counts["repaired" if count == 0 else "jitter"] += 1
+            return sigma + jitter * identity, L
+        except LA.LinAlgError:
+            jitter = jitter * 10
+    raise LA.LinAlgError("could not make the covariance matrix positive-definite")
+
+
+# estimate mean and covariance of `X_obs` and make the covariance positive-definite.
+# The estimate is permutation-equivariant, so it only needs to be computed once for all permutations
+def estimate_mean_cov(X_obs):
     n, p = X_obs.shape
-    assert p == len(X_int), "dimensions mismatch!"
-    assert sorted(perm) == list(range(0, p)), "perm is not a permutation vector"
-    # permute X_obs and X_int
-    X_obs_perm = X_obs[:, perm]
-    X_int_perm = X_int[perm]
-    # estimate covariance and mean
-    mu = np.mean(X_obs_perm, axis=0)
+    mu = np.mean(X_obs, axis=0)
     if n > p:
-        sigma = np.cov(X_obs_perm.transpose())
+        sigma = np.atleast_2d(np.cov(X_obs.transpose()))
     else:
         # it is possible to use other estimators here
-        cov = ShrunkCovariance().fit(X_obs_perm)
+        cov = ShrunkCovariance().fit(X_obs)
         sigma = cov.covariance_
 
     # ensure positive-definite
-    min_eigenvalue = min(LA.eigvals(sigma))
-    if min_eigenvalue < 1e-6:
-        sigma = sigma + abs(min_eigenvalue) + 1e-6
+    sigma, _ = make_positive_definite(sigma)
+    return mu, sigma
+
+
+# covariance estimate of `estimate_mean_cov` (before the positive-definite correction), computed from the sample
+# covariance `cov` of `n` observations instead of from the data
+def covariance_from_sample(cov, n):
+    p = cov.shape[0]
+    if n > p:
+        return cov
+    # `ShrunkCovariance` shrinks the biased (1/n) empirical covariance
+    return shrunk_covariance(cov * (n - 1) / n)
+
+
+# Mean and covariance of an observational cohort `X_obs`, as estimated by `estimate_mean_cov`. It is built once per
+# cohort and a permutation is applied by gathering rows and columns of the cached estimates
+class ReferenceModel:
+    def __init__(self, mu, sigma, n):
+        self.n, self.p = n, len(mu)
+        self.mu, self.sigma = mu, sigma
+
+    @classmethod
+    def from_data(cls, X_obs):
+        mu, sigma = estimate_mean_cov(X_obs)
+        return cls(mu, sigma, X_obs.shape[0])
+
+    # mean and covariance of the permuted variables
+    def permute(self, perm):
+        return self.mu[perm], self.sigma[np.ix_(perm, perm)]
+
+
+# Streaming mean, variance and (if `track_cov`) covariance of observational data. Statistics are accumulated from
+# row batches with the pairwise update of Chan et al. (Welford's update for a batch of rows), so the cohort never has
+# to be held in memory at once. References of different shards can be merged, and saved to / loaded from .npz files.
+# It can be used in place of `X_obs` in `zscore`, and in place of a `ReferenceModel`
+class ObservationalReference:
+    def __init__(self, p, track_cov=True):
+        self.p = p
+        self.n = 0
+        self.mean = np.zeros(p)
+        self.m2 = np.zeros(p)  # sums of squared deviations from the mean
+        self.comoment = np.zeros((p, p)) if track_cov else None  # sums of products of deviations from the mean
+        self._model = None
+
+    @classmethod
+    def from_data(cls, X_obs, chunk_size=1000, track_cov=True):
+        reference = cls(X_obs.shape[1], track_cov)
+        for start in range(0, X_obs.shape[0], chunk_size):
+            reference.update(X_obs[start:(start + chunk_size)])
+        return reference
+
+    # add the rows of `X_batch` to the statistics
+    def update(self, X_batch):
+        X_batch = np.atleast_2d(X_batch)
+        assert X_batch.shape[1] == self.p, "Number of variables mismatch"
+        mean_b = np.mean(X_batch, axis=0)
+        dev = X_batch - mean_b
+        comoment_b = dev.T @ dev if self.comoment is not None else None
+        self._merge(X_batch.shape[0], mean_b, np.sum(dev ** 2, axis=0), comoment_b)
+        return self
+
+    # add the statistics of another shard
+    def merge(self, other):
+        assert other.p == self.p, "Number of variables mismatch"
+        if self.comoment is not None and other.comoment is None:
+            raise ValueError("cannot merge a reference without covariance into one with covariance")
+        self._merge(other.n, other.mean, other.m2, other.comoment)
+        return self
+
+    def _merge(self, n_b, mean_b, m2_b, comoment_b):
+        if n_b == 0:
+            return
+        n = self.n + n_b
+        delta = mean_b - self.mean
+        weight = self.n * n_b / n
+        self.mean = self.mean + delta * (n_b / n)
+        self.m2 = self.m2 + m2_b + delta ** 2 * weight
+        if self.comoment is not None:
+            self.comoment += comoment_b + np.outer(delta, delta) * weight
+        self.n = n
+        self._model = None
+
+    # sample variance, std and covariance (ddof=1)
+    @property
+    def var(self):
+        return self.m2 / (self.n - 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    @property
+    def cov(self):
+        if self.comoment is None:
+            raise ValueError("the covariance was not tracked (track_cov=False)")
+        return self.comoment / (self.n - 1)
+
+    # `ReferenceModel` of the variables `idx` (all variables by default), with the estimator of `estimate_mean_cov`
+    def reference_model(self, idx=None):
+        if idx is None:
+            if self._model is None:
+                self._model = self.reference_model(np.arange(self.p))
+            return self._model
+        idx = np.asarray(idx)
+        cov = self.comoment[np.ix_(idx, idx)] / (self.n - 1) if self.comoment is not None else self.cov
+        sigma, _ = make_positive_definite(covariance_from_sample(cov, self.n))
+        return ReferenceModel(self.mean[idx], sigma, self.n)
+
+    def save(self, path):
+        arrays = {"n": self.n, "mean": self.mean, "m2": self.m2}
+        if self.comoment is not None:
+            arrays["comoment"] = self.comoment
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        reference = cls(len(data["mean"]), track_cov="comoment" in data)
+        reference.n = int(data["n"])
+        reference.mean, reference.m2 = data["mean"], data["m2"]
+        if "comoment" in data:
+            reference.comoment = data["comoment"]
+        return reference
+
+
+# `ReferenceModel` of `reference`, which may also be an `ObservationalReference`, or of `X_obs` if `reference` is None
+def _reference_model(X_obs, reference=None):
+    if reference is None:
+        return get_reference_model(X_obs)
+    if isinstance(reference, ObservationalReference):
+        return reference.reference_model()
+    return reference
+
+
+# cache of `ReferenceModel`s keyed by observational cohort, see `get_reference_model`
+_reference_models = OrderedDict()
+
+
+# key identifying an observational cohort. Hashing the data costs O(n*p), estimating the covariance O(n*p^2)
+def cohort_key(X_obs):
+    X_obs = np.ascontiguousarray(X_obs)
+    return X_obs.shape, X_obs.dtype.str, hashlib.sha1(X_obs).hexdigest()
+
+
+# sha1 of the shapes and contents of `arrays`, which may be None or scipy sparse matrices (hashed in CSC form)
+def array_digest(*arrays):
+    digest = hashlib.sha1()
+    for a in arrays:
+        if a is None:
+            digest.update(b"None")
+            continue
+        if sparse.issparse(a):
+            a = sparse.csc_matrix(a)
+            a.sort_indices()
+            parts = (a.data, a.indices, a.indptr)
+        else:
+            parts = (np.asarray(a),)
+        digest.update(str(a.shape).encode())
+        for part in parts:
+            part = np.ascontiguousarray(part)
+            digest.update(part.dtype.str.encode())
+            digest.update(part)
+    return digest.hexdigest()
+
+
+# `ReferenceModel` of `X_obs`, re-used if the same cohort was seen before. At most `maxsize` models are kept
+def get_reference_model(X_obs, maxsize=4):
+    key = cohort_key(X_obs)
+    if key in _reference_models:
+        _reference_models.move_to_end(key)
+        return _reference_models[key]
+    reference = ReferenceModel.from_data(X_obs)
+    _reference_models[key] = reference
+    while len(_reference_models) > maxsize:
+        _reference_models.popitem(last=False)
+    return reference
+
+
+# Basic root cause discovery function with 'perm' as an input
+# `X_obs` is a matrix, `X_int` a vector, `perm` a permutation vector.
+# If `reference` (a `ReferenceModel` or `ObservationalReference` of `X_obs`) is given, mean and covariance are taken
+# from it. `check=False` skips validating `perm`, for callers that generate it themselves
+def root_cause_discovery(X_obs, X_int, perm, reference=None, check=True):
+    if not isinstance(perm, np.ndarray):
+        perm = np.array(perm)
+    if reference is not None:
+        reference = _reference_model(X_obs, reference)
+    p = X_obs.shape[1] if reference is None else reference.p
+    assert p == len(X_int), "dimensions mismatch!"
+    if check:
+        assert np.array_equal(np.sort(perm), np.arange(p)), "perm is not a permutation vector"
+    # permute X_int
+    X_int_perm = X_int[perm]
+    # estimate covariance and mean of the permuted X_obs
+    if reference is None:
+        mu, sigma = estimate_mean_cov(X_obs[:, perm])
+    else:
+        mu, sigma = reference.permute(perm)
     # compute cholesky
     L = LA.cholesky(sigma)
     # solve for Xtilde in L*Xtilde = X_int_perm - mu
@@ -104,30 +411,203 @@ def root_cause_discovery(X_obs, X_int, perm):
     return abs(X_tilde)
 
 
+# Cholesky factor `L_N` of the normal block, `K = L_N^{-1} sigma_NA`, and the Schur complement `S` of the aberrant
+# block given the normal block. None of these depend on the ordering of the aberrant block
+def schur_factors(sigma, idx_normal, idx_aberrant):
+    sigma_NA = sigma[np.ix_(idx_normal, idx_aberrant)]
+    sigma_AA = sigma[np.ix_(idx_aberrant, idx_aberrant)]
+    if len(idx_normal) == 0:
+        return np.zeros((0, 0)), sigma_NA, sigma_AA
+    L_N = LA.cholesky(sigma[np.ix_(idx_normal, idx_normal)])
+    K = solve_triangular(L_N, sigma_NA, lower=True)
+    S = sigma_AA - K.T @ K
+    return L_N, K, S
+
+
+# whitened normal block `w_N` and conditional residual `c` of the aberrant block given the normal block
+def schur_whiten(mu, X_int, idx_normal, idx_aberrant, L_N, K):
+    r_N = X_int[idx_normal] - mu[idx_normal]
+    w_N = solve_triangular(L_N, r_N, lower=True) if len(idx_normal) > 0 else r_N
+    c = X_int[idx_aberrant] - mu[idx_aberrant] - K.T @ w_N
+    return w_N, c
+
+
+# Same output as calling `root_cause_discovery` on every row of `perms`, for permutations that share their first
+# `n_normal` entries (e.g. from `compute_permutations(..., shuffle_normal=False)`). `mu` and `sigma` come from
+# `estimate_mean_cov(X_obs)` or a `ReferenceModel`. The normal block is factored once, and only the small Schur
+# complement of the aberrant block is factored for each permutation. Returns a (n_perms x p) matrix of |Xtilde|.
+# `factors` are the `schur_factors` of the normal block if they are already known. `check=False` skips validating
+# that the permutations share their normal block, for callers that generate them themselves
+def root_cause_discovery_schur(mu, sigma, X_int, perms, n_normal, factors=None, check=True):
+    perms = np.asarray(perms)
+    n_perms, p = perms.shape
+    assert p == len(X_int), "dimensions mismatch!"
+    idx_normal = perms[0, :n_normal]
+    if check:
+        assert np.all(perms[:, :n_normal] == idx_normal), "permutations must share the same normal block"
+    idx_aberrant = np.sort(perms[0, n_normal:])
+
+    if factors is None:
+        factors = schur_factors(sigma, idx_normal, idx_aberrant)
+    L_N, K, S = factors
+    w_N, c = schur_whiten(mu, X_int, idx_normal, idx_aberrant, L_N, K)
+
+    Xtilde = np.zeros((n_perms, p))
+    Xtilde[:, idx_normal] = abs(w_N)
+    _whiten_aberrant_block(Xtilde, perms[:, n_normal:], idx_aberrant, S, c)
+    return Xtilde
+
+
+# fill in |Xtilde| of the aberrant block for every row of `perms_aberrant` (orderings of the sorted `idx_aberrant`),
+# given the Schur complement `S` and the conditional residual `c` of `idx_aberrant`
+def _whiten_aberrant_block(Xtilde, perms_aberrant, idx_aberrant, S, c):
+    n_perms, k = perms_aberrant.shape
+    # position of each aberrant variable within `idx_aberrant`
+    pos = np.zeros(Xtilde.shape[1], dtype=int)
+    pos[idx_aberrant] = np.arange(len(idx_aberrant))
+    for start in range(0, n_perms, _batch_rows(k)):
+        rows = np.arange(start, min(start + _batch_rows(k), n_perms))
+        order = pos[perms_aberrant[rows]]
+        # stacked Schur complements and residuals of the aberrant block, one per permutation
+        L_A = LA.cholesky(S[order[:, :, None], order[:, None, :]])
+        Xtilde[rows[:, None], perms_aberrant[rows]] = abs(solve_lower_batched(L_A, c[order]))
+
+
+# Block elimination of the covariance along an ascending threshold sweep. When the threshold rises, the aberrant
+# variables with z <= threshold migrate to the end of the normal block, and the Schur complement of the remaining
+# aberrant block is downdated with the migrated block only (a rank-k update). The whole sweep then costs about one
+# Cholesky of `sigma`, instead of one factorization of the normal block per threshold. The normal block is ordered
+# by migration, hence its whitened values can differ from `root_cause_discovery_schur`, where it is in ascending order
+class IncrementalSchur:
+    def __init__(self, mu, sigma, X_int):
+        self.p = len(X_int)
+        self.threshold = -np.inf
+        self.idx_normal = np.zeros(0, dtype=int)
+        self.idx_aberrant = np.arange(self.p)
+        self.w_N = np.zeros(0)
+        self.S = sigma.copy()
+        self.c = X_int - mu
+
+    # move the aberrant variables with `z <= threshold` to the normal block
+    def advance(self, z, threshold):
+        assert threshold >= self.threshold, "thresholds must be visited in ascending order"
+        self.threshold = threshold
+        migrate = z[self.idx_aberrant] <= threshold
+        if not np.any(migrate):
+            return
+        M, R = np.where(migrate)[0], np.where(~migrate)[0]
+        L_M = LA.cholesky(self.S[np.ix_(M, M)])
+        w_M = solve_triangular(L_M, self.c[M], lower=True)
+        K = solve_triangular(L_M, self.S[np.ix_(M, R)], lower=True)
+        self.S = self.S[np.ix_(R, R)] - K.T @ K
+        self.c = self.c[R] - K.T @ w_M
+        self.w_N = np.concatenate([self.w_N, w_M])
+        self.idx_normal = np.concatenate([self.idx_normal, self.idx_aberrant[M]])
+        self.idx_aberrant = self.idx_aberrant[R]
+
+    # (n_perms x p) matrix of |Xtilde| for orderings `perms_aberrant` of the current aberrant block
+    def root_cause_discovery(self, perms_aberrant):
+        perms_aberrant = np.asarray(perms_aberrant)
+        Xtilde = np.zeros((perms_aberrant.shape[0], self.p))
+        Xtilde[:, self.idx_normal] = abs(self.w_N)
+        _whiten_aberrant_block(Xtilde, perms_aberrant, self.idx_aberrant, self.S, self.c)
+        return Xtilde
+
+
+# |Xtilde| of the permutations of each threshold, computed with `root_cause_discovery_schur` or, if `incremental`,
+# with one `IncrementalSchur` for the whole (sorted) sweep
+def _threshold_sweep(reference, X_int, z, thresholds, nshuffles=1, verbose=True, incremental=False, seed=None):
+    rng = _random_generator(seed)
+    if incremental:
+        thresholds = np.sort(thresholds)
+        sweep = IncrementalSchur(reference.mu, reference.sigma, X_int)
+    for threshold in thresholds:
+        permutations = compute_permutations(z, threshold=threshold, nshuffles=nshuffles, shuffle_normal=False,
+                                            seed=rng)
+        if verbose:
+            print("Trying", len(permutations), "permutations for threshold", threshold)
+        if len(permutations) == 0:
+            continue
+        n_normal = np.sum(z <= threshold)
+        if incremental:
+            sweep.advance(z, threshold)
+            yield sweep.root_cause_discovery(permutations[:, n_normal:])
+        else:
+            # the normal block of `compute_permutations(..., shuffle_normal=False)` is in ascending order
+            factors = schur_factors(reference.sigma, np.where(z <= threshold)[0], np.where(z > threshold)[0])
+            yield root_cause_discovery_schur(reference.mu, reference.sigma, X_int, permutations, n_normal, factors,
+                                             check=False)
+
+
+# number of (k x k) matrices stacked in one batched Cholesky, so that a batch holds about 2^24 entries
+def _batch_rows(k, max_entries=2 ** 24):
+    return max(1, max_entries // max(1, k * k))
+
+
+# solve L[i] @ x[i] = b[i] for a stack of lower-triangular matrices `L` (m x k x k) and right-hand sides `b` (m x k),
+# by forward substitution vectorized over the stack
+def solve_lower_batched(L, b):
+    x = np.zeros(b.shape)
+    for j in range(b.shape[1]):
+        x[:, j] = (b[:, j] - np.einsum("ij,ij->i", L[:, j, :j], x[:, :j])) / L[:, j, j]
+    return x
+
+
+# `root_cause_discovery` for a stack of arbitrary permutations `perms` (n_perms x p). Covariances of each batch of
+# permutations are gathered from `reference` (a `ReferenceModel` or `ObservationalReference` of `X_obs`) and factored
+# with one batched Cholesky. Returns a (n_perms x p) matrix of |Xtilde|
+def root_cause_discovery_batch(X_obs, X_int, perms, reference=None):
+    perms = np.asarray(perms)
+    reference = _reference_model(X_obs, reference)
+    n_perms, p = perms.shape
+    assert p == len(X_int), "dimensions mismatch!"
+    Xtilde = np.zeros((n_perms, p))
+    for start in range(0, n_perms, _batch_rows(p)):
+        rows = np.arange(start, min(start + _batch_rows(p), n_perms))
+        perm = perms[rows]
+        L = LA.cholesky(reference.sigma[perm[:, :, None], perm[:, None, :]])
+        # undo the permutations by scattering each row back
+        Xtilde[rows[:, None], perm] = abs(solve_lower_batched(L, X_int[perm] - reference.mu[perm]))
+    return Xtilde
+
+
+# largest entry, its index and the second largest entry of each row of `Xtilde_all`
+def top_two(Xtilde_all):
+    Xtilde_all = np.atleast_2d(Xtilde_all)
+    max_index = np.argmax(Xtilde_all, axis=1)
+    largest_two = np.partition(Xtilde_all, -2, axis=1)[:, -2:]
+    return max_index, largest_two[:, 1], largest_two[:, 0]
+
+
+# (largest - second largest) / second largest of each row of `Xtilde_all`, together with the index of the largest
+def one_nonzero_quantification(Xtilde_all):
+    max_index, largest, second_largest = top_two(Xtilde_all)
+    return (largest - second_largest) / second_largest, max_index
+
+
 # Main root cause discovery function (Algo 3 in the paper)
-def root_cause_discovery_main(X_obs, X_int, nshuffles=1, thresholds=None, verbose=True):
-    p = X_obs.shape[1]
-    assert p == len(X_int), "Number of variables mismatch"
+# `reference` is the `ReferenceModel` of `X_obs`, it is looked up with `get_reference_model` if not given. It can also
+# be an `ObservationalReference`, then z scores are computed from it as well and `X_obs` may be None.
+# With `incremental=True` the Schur complements are updated along the threshold sweep, see `IncrementalSchur`.
+# `z` are the z scores of `X_int`, if already computed. `seed` is passed to `_random_generator`
+def root_cause_discovery_main(X_obs, X_int, nshuffles=1, thresholds=None, verbose=True, reference=None,
+                              incremental=False, z=None, seed=None):
+    p = len(X_int)
+    assert X_obs is None or p == X_obs.shape[1], "Number of variables mismatch"
     # compute z scores
-    z = zscore(X_obs, X_int)
+    if z is None:
+        z = zscore(reference if isinstance(reference, ObservationalReference) else X_obs, X_int)
 
     if thresholds is None:
         thresholds = get_aberrant_thresholds(z, thre_min=0.1, thre_max=5, thre_seq=0.2)
 
+    # mean and covariance do not depend on the permutation
+    reference = _reference_model(X_obs, reference)
     root_cause_score = np.zeros(p)
-    for threshold in thresholds:
-        permutations = compute_permutations(z, threshold=threshold, nshuffles=nshuffles)
-        if verbose:
-            print("Trying", len(permutations), "permutations for threshold", threshold)
-
-        # try all permutations to calculate 'Xtilde'
-        for perm in permutations:
-            Xtilde = root_cause_discovery(X_obs, X_int, perm)
-            sorted_X = sorted(Xtilde)
-            OneNonZero_quantification = (sorted_X[-1] - sorted_X[-2]) / sorted_X[-2]
-            max_index = np.argmax(Xtilde)
-            if root_cause_score[max_index] < OneNonZero_quantification:
-                root_cause_score[max_index] = OneNonZero_quantification
+    # try all permutations to calculate 'Xtilde'
+    for Xtilde_all in _threshold_sweep(reference, X_int, z, thresholds, nshuffles, verbose, incremental, seed):
+        OneNonZero_quantification, max_index = one_nonzero_quantification(Xtilde_all)
+        np.fmax.at(root_cause_score, max_index, OneNonZero_quantification)
 
     # assign final root cause score for variables that never had maximal Xtilde_i
     idx2 = np.where(root_cause_score == 0)[0]
@@ -138,30 +618,42 @@ def root_cause_discovery_main(X_obs, X_int, nshuffles=1, thresholds=None, verbos
     return root_cause_score
 
 
+# Multi-patient version of `root_cause_discovery_main`: scores each row of the (m x p) matrix `X_int` against the same
+# `X_obs`. z scores are computed in one pass, and all patients share the reference model (mean and covariance
+# estimate) of `X_obs`. Returns a (m x p) matrix of root cause scores
+def root_cause_discovery_main_batch(X_obs, X_int, nshuffles=1, thresholds=None, verbose=True, reference=None,
+                                    incremental=False, seed=None):
+    X_int = np.atleast_2d(X_int)
+    m, p = X_int.shape
+    assert X_obs is None or p == X_obs.shape[1], "Number of variables mismatch"
+    z = zscore(reference if isinstance(reference, ObservationalReference) else X_obs, X_int)
+    reference = _reference_model(X_obs, reference)
+    rng = _random_generator(seed)
+
+    root_cause_scores = np.zeros((m, p))
+    for i in range(m):
+        if verbose:
+            print("Patient", i)
+        root_cause_scores[i] = root_cause_discovery_main(X_obs, X_int[i], nshuffles, thresholds, verbose, reference,
+                                                         incremental, z[i], rng)
+    return root_cause_scores
+
+
 # this is same function as 'reduce_gene'
-def reduce_dimension(y_idx, X_obs, X_int, verbose=True):
-    # response and design matrix for Lasso
-    y = X_obs[:, y_idx]
-    X = np.delete(X_obs, y_idx, axis=1)
-    n = len(y)
-
-    # fit CV-lasso
-    with warnings.catch_warnings():  # ignore the convergence warnings from 'enet_path'
-        warnings.simplefilter("ignore")
-        lasso_cv = LassoCV().fit(X, y)
-        beta_final = lasso_cv.coef_
-        if np.sum(beta_final != 0) <= 1:  # in this case return n/2 variables
-            _, coef_path, _ = lasso_path(X, y)
-            num_nonzeros = np.sum((coef_path != 0), axis=0)
-            alpha_idx = np.argmin(np.abs(num_nonzeros - n / 2))
-            beta_final = coef_path[:, alpha_idx]
-
-    nz = np.count_nonzero(beta_final)
+# The nodewise Lasso is looked up in (and added to) `mb_index`, a `MarkovBlanketIndex` of `X_obs`, if given
+# `lasso_engine` is an optional `GramLasso` of `X_obs` or function with the signature of `nodewise_lasso`, used
+# instead of `nodewise_lasso`
+def reduce_dimension(y_idx, X_obs, X_int, verbose=True, mb_index=None, lasso_engine=None):
+    fit = nodewise_lasso if lasso_engine is None else lasso_engine
+    if mb_index is None:
+        selected_idx, _, _ = fit(y_idx, X_obs)
+    else:
+        selected_idx, _, _ = mb_index.get(y_idx, X_obs, fit)
+
+    nz = len(selected_idx)
     if verbose:
         print("Treat", y_idx, "as response, found ", nz, " non-zero entries")
-    # for non-zero idx, find the original indices in X_obs, and don't forget to include y_idx
-    selected_idx = np.nonzero(beta_final)[0]
-    selected_idx = np.array([idx + 1 if idx >= y_idx else idx for idx in selected_idx])
+    # don't forget to include y_idx
     selected_idx = np.append(selected_idx, y_idx)
     # return the subset of variables of X_obs that were selected
     X_obs_new = X_obs[:, selected_idx]
@@ -175,45 +667,106 @@ def reduce_dimension(y_idx, X_obs, X_int, verbose=True):
 
 
 # Function to parallel
+# If `reference` (an `ObservationalReference` of `X_obs`) is given, z scores and covariance of the selected variables
+# are taken from it; `X_obs` is then only used by the Lasso and may be None when `Precision_mat` is given.
+# `mb_index` is an optional `MarkovBlanketIndex` of `X_obs` and `lasso_engine` is passed to `reduce_dimension`.
+# `seed` is passed to `_random_generator`
 def process_y_idx_rcd(
         y_idx,
         X_obs,
         X_int,
         nshuffles=1,
         verbose=True,
-        Precision_mat=None):
+        Precision_mat=None,
+        incremental=False,
+        reference=None,
+        seed=None,
+        mb_index=None,
+        lasso_engine=None):
     if Precision_mat is None:
-        X_obs_new, X_int_sample_new, selected_idx = reduce_dimension(y_idx, X_obs, X_int, verbose)
+        X_obs_new, X_int_sample_new, selected_idx = reduce_dimension(y_idx, X_obs, X_int, verbose, mb_index,
+                                                                     lasso_engine)
         select_len_y = len(selected_idx)
     else:
-        MB = np.where(Precision_mat[:, y_idx] != 0)[0]
-        MB = np.delete(MB, np.where(MB == y_idx)[0][0])
-        MB = np.append(MB, y_idx)  # put y_idx in the end
-        X_obs_new = X_obs[:, MB]
-        X_int_sample_new = X_int[MB]
-        select_len_y = len(MB)
+        # `Precision_mat` may be a scipy sparse matrix, e.g. from `estimate_precision_matrix`
+        if sparse.issparse(Precision_mat):
+            MB = Precision_mat[:, [y_idx]].nonzero()[0]
+        else:
+            MB = np.where(Precision_mat[:, y_idx] != 0)[0]
+        MB = MB[MB != y_idx]
+        selected_idx = np.append(MB, y_idx)  # put y_idx in the end
+        X_obs_new = X_obs[:, selected_idx] if X_obs is not None else None
+        X_int_sample_new = X_int[selected_idx]
+        select_len_y = len(selected_idx)
+        if select_len_y == 1:  # empty Markov blanket, y_idx is given the score of variables without one
+            return y_idx, 0, select_len_y
 
-    z_new = zscore(X_obs_new, X_int_sample_new)
+    if reference is None:
+        z_new = zscore(X_obs_new, X_int_sample_new)
+        model = ReferenceModel.from_data(X_obs_new)
+    else:
+        z_new = zscore(None, X_int_sample_new, mu=reference.mean[selected_idx], sigma=reference.std[selected_idx])
+        if reference.comoment is not None:
+            model = reference.reference_model(selected_idx)
+        else:
+            model = ReferenceModel.from_data(X_obs_new)
 
     thresholds = get_aberrant_thresholds(z_new, thre_min=0.1, thre_max=5, thre_seq=0.2)
-    for threshold in thresholds:
-        permutations = compute_permutations(z_new, threshold=threshold, nshuffles=nshuffles)
-        if verbose:
-            print("Trying", len(permutations), "permutations for threshold", threshold)
+    root_cause_score_y = 0
+    # try all permutations to calculate 'Xtilde' and update 'best_OneNonZero_quantification'. The score is the best
+    # over all thresholds, as in `root_cause_discovery_main` and the Julia implementation
+    for Xtilde_all in _threshold_sweep(model, X_int_sample_new, z_new, thresholds, nshuffles, verbose, incremental,
+                                       seed):
+        OneNonZero_quantification, max_index = one_nonzero_quantification(Xtilde_all)
+        # recall that the last variable is the one treated as response
+        matched = max_index == (Xtilde_all.shape[1] - 1)
+        if np.any(matched):
+            root_cause_score_y = max(root_cause_score_y, np.max(OneNonZero_quantification[matched]))
+
+    return y_idx, root_cause_score_y, select_len_y
 
-        # try all permutations to calculate 'Xtilde' and update 'best_OneNonZero_quantification'
-        root_cause_score_y = 0
-        for perm in permutations:
-            Xtilde = root_cause_discovery(X_obs_new, X_int_sample_new, perm)
-            sorted_X = sorted(Xtilde)
-            OneNonZero_quantification = (sorted_X[-1] - sorted_X[-2]) / sorted_X[-2]
 
-            max_index = np.argmax(Xtilde)
-            if max_index == (len(Xtilde)-1):  # recall that the last variable is the one treated as response
-                if root_cause_score_y < OneNonZero_quantification:
-                    root_cause_score_y = OneNonZero_quantification
+# `process_y_idx_rcd` in a worker, returned with the counts of the paths of `make_positive_definite` it took, which the
+# module counters of a worker process would not pass on to the caller
+def process_y_idx_counted(*args):
+    before = pd_repair_stats()
+    result = process_y_idx_rcd(*args)
+    return result, {key: count - before[key] for key, count in pd_repair_stats().items()}
 
-    return y_idx, root_cause_score_y, select_len_y
+
+# Estimated relative cost of the task of each of `y_indices` in `root_cause_discovery_highdim_parallel`, for
+# scheduling: the number of thresholds (at most one per step of the threshold grid below z and per variable) times the
+# cubic cost of the decompositions of the selected variables. The Markov blanket size is read from `Precision_mat` or
+# `mb_index` when known; otherwise the Lasso is still to be fitted and n/2 variables are assumed
+def estimate_task_costs(y_indices, z, n, Precision_mat=None, mb_index=None):
+    if Precision_mat is not None:
+        sizes = np.asarray((Precision_mat[:, y_indices] != 0).sum(axis=0)).ravel().astype(float)
+    else:
+        sizes = np.full(len(y_indices), n / 2 + 1)
+        if mb_index is not None:
+            for i, y_idx in enumerate(y_indices):
+                size = mb_index.blanket_size(y_idx)
+                if size is not None:
+                    sizes[i] = size + 1
+    n_thresholds = np.minimum(np.searchsorted(np.arange(0.1, 5, 0.2), z[y_indices]), sizes)
+    return np.maximum(n_thresholds, 1) * sizes ** 3
+
+
+# `estimate_precision_matrix(X_obs, precision_method, n_jobs=n_jobs, fit=fit)`, loaded from the file `path` if it holds
+# the estimate of the same `X_obs`, method and `fit`, otherwise computed and saved to `path` (if not None)
+def _estimate_precision_checkpointed(X_obs, precision_method, n_jobs, fit, path=None):
+    key = hashlib.sha1(json.dumps([array_digest(X_obs), precision_method, describe_fit(fit)]).encode()).hexdigest()
+    if path is not None and os.path.exists(path):
+        with np.load(path) as data:
+            if str(data["key"]) == key:
+                return sparse.csc_matrix((data["data"], data["indices"], data["indptr"]), shape=tuple(data["shape"]))
+    precision = estimate_precision_matrix(X_obs, precision_method, n_jobs=n_jobs, fit=fit)
+    if path is not None:
+        with open(path + ".part", "wb") as io:
+            np.savez(io, key=key, data=precision.data, indices=precision.indices, indptr=precision.indptr,
+                     shape=precision.shape)
+        os.replace(path + ".part", path)
+    return precision
 
 
 def root_cause_discovery_highdim_parallel(
@@ -223,19 +776,162 @@ def root_cause_discovery_highdim_parallel(
         y_idx_z_threshold=1.5,
         nshuffles=1,
         verbose=True,
-        Precision_mat=None):  # New parameter to specify the number of cores
-    n, p = X_obs.shape
-    z = zscore(X_obs, X_int)
+        Precision_mat=None,
+        incremental=False,
+        reference=None,
+        seed=None,
+        mb_index=None,
+        lasso_engine="sklearn",
+        screen=None,
+        kkt_check=False,
+        precision_method=None,
+        share_memory=True,
+        return_info=False,
+        schedule="cost",
+        execution_policy="auto",
+        checkpoint=None,
+        top_k=None,
+        patience=20):  # New parameter to specify the number of cores
+    p = len(X_int)
+    # `reference` is an optional `ObservationalReference` of `X_obs`, see `process_y_idx_rcd`
+    z = zscore(X_obs if reference is None else reference, X_int)
+    # `mb_index` is a `MarkovBlanketIndex` of `X_obs` or the directory of one, re-used across patients
+    if isinstance(mb_index, str):
+        mb_index = MarkovBlanketIndex(mb_index)
+    if mb_index is not None:
+        mb_index.check_cohort(X_obs)
+    # `lasso_engine` is "sklearn" (`LassoCV` for each y_idx), "gram" (a `GramLasso` of `X_obs`, whose Gram matrix is
+    # computed once for all y_idx) or a `GramLasso` instance. With "sklearn", `screen` and `kkt_check` are passed to
+    # `nodewise_lasso` to screen the predictors of each y_idx; the other engines do not screen
+    if screen not in (None, "sis", "strong"):
+        raise ValueError("unknown screening rule: " + str(screen))
+    if (screen is not None or kkt_check) and lasso_engine != "sklearn":
+        raise ValueError("screen and kkt_check are only used with lasso_engine='sklearn'")
+    if kkt_check and screen is None:
+        raise ValueError("kkt_check needs a screen")
+    if lasso_engine == "gram":
+        lasso_engine = GramLasso(X_obs) if Precision_mat is None and precision_method != "glasso" else None
+    elif lasso_engine == "sklearn":
+        lasso_engine = None if screen is None else partial(nodewise_lasso, screen=screen, kkt_check=kkt_check)
+    elif not isinstance(lasso_engine, GramLasso):
+        raise ValueError("lasso_engine should be 'sklearn', 'gram' or a GramLasso")
+    # the fits stored in `mb_index` must come from the same Lasso
+    if mb_index is not None and Precision_mat is None and precision_method is None:
+        mb_index.check_fit(nodewise_lasso if lasso_engine is None else lasso_engine)
+    # with a `precision_method` ("glasso" or "nodewise"), the Markov blankets are the non-zeros of one precision matrix
+    # estimated once from X_obs by `estimate_precision_matrix` (with the Lasso of `lasso_engine` for "nodewise")
+    # With a `checkpoint`, the estimate is saved next to it and re-used when the run is resumed
+    if Precision_mat is None and precision_method is not None:
+        Precision_mat = _estimate_precision_checkpointed(X_obs, precision_method, n_jobs,
+                                                         nodewise_lasso if lasso_engine is None else lasso_engine,
+                                                         None if checkpoint is None else checkpoint + ".precision.npz")
     y_indices = np.where(z > y_idx_z_threshold)[0]
-
-    # Parallelize the processing of y_indices
-    results = Parallel(n_jobs=n_jobs)(delayed(process_y_idx_rcd)(y_idx, X_obs, X_int, nshuffles,
-                                                                 verbose, Precision_mat) for y_idx in y_indices)
+    # with schedule="cost", the tasks are dispatched one at a time, longest first by `estimate_task_costs`: a worker
+    # takes the next task as soon as it is done, so that the run does not end with one core on a long task.
+    # With schedule="index", they are dispatched in index order with joblib's automatic batching
+    if schedule == "cost":
+        costs = estimate_task_costs(y_indices, z, reference.n if X_obs is None else X_obs.shape[0], Precision_mat,
+                                    mb_index)
+        y_indices = y_indices[np.argsort(-costs, kind="stable")]
+    elif schedule != "index":
+        raise ValueError("schedule should be 'cost' or 'index'")
+
+    # With `top_k`, the search is an anytime search for the `top_k` highest scores: candidates are processed in
+    # descending z order and the run stops once `patience` results in a row did not enter the running top `top_k`.
+    # The rule is a heuristic, a later candidate could still score higher. Candidates that were not processed are
+    # scored like variables without a score, and info["complete"] tells whether all candidates were processed
+    n_candidates = len(y_indices)
+    if top_k is not None:
+        y_indices = y_indices[np.argsort(-z[y_indices], kind="stable")]
+
+    # With a `checkpoint` file (see `CheckpointStore`), the result of each y_idx is appended to it as soon as it is
+    # done, and the y_idx already in it are not computed again: an interrupted run is resumed by calling this function
+    # again with the same arguments. A precision matrix estimated with `precision_method` is kept in
+    # `<checkpoint>.precision.npz`, so it is not estimated again either
+    store = None
+    if checkpoint is not None:
+        # everything the scores depend on: the data, the Markov blankets (Precision_mat, given or estimated, or the
+        # Lasso that selects them) and the reference statistics
+        # (numpy scalars are converted, JSON cannot represent them)
+        meta = {"p": int(p), "X_int": array_digest(X_int), "X_obs": None if X_obs is None else array_digest(X_obs),
+                "y_idx_z_threshold": float(y_idx_z_threshold), "nshuffles": int(nshuffles),
+                "seed": None if seed is None else int(seed), "incremental": bool(incremental),
+                "Precision_mat": None if Precision_mat is None else array_digest(Precision_mat),
+                "precision_method": precision_method,
+                "lasso_engine": describe_fit(nodewise_lasso if lasso_engine is None else lasso_engine),
+                "screen": screen, "kkt_check": bool(kkt_check),
+                "mb_index": None if mb_index is None else mb_index.path,
+                "reference": None if reference is None else
+                array_digest(np.array([reference.n]), reference.mean, reference.m2, reference.comoment)}
+        store = CheckpointStore(checkpoint, meta)
+        y_indices = np.array([y_idx for y_idx in y_indices if y_idx not in store], dtype=int)
+
+    # `execution_policy` splits the cores into processes and BLAS threads per process, see `resolve_execution_policy`;
+    # the thread limit is applied inside each worker, to avoid n_jobs x n_cores BLAS threads
+    processes, threads = resolve_execution_policy(execution_policy, n_jobs, p, len(y_indices))
+
+    # Parallelize the processing of y_indices. With a `seed`, each y_idx gets its own reproducible random stream.
+    # With `share_memory`, the large arrays (X_obs, X_int, Precision_mat and those of `reference` and `lasso_engine`)
+    # are written once to memory-mapped files instead of being pickled for every task
     root_cause_score = np.zeros(p)
     select_len = np.zeros(p)
-    for y_idx, score, length in results:
-        root_cause_score[y_idx] = score
-        select_len[y_idx] = length
+    worker_memory = {}  # peak resident memory (bytes) of each worker process
+    seconds = {}  # time taken by each y_idx
+    pd_repair = dict.fromkeys(_pd_repair_counts, 0)  # paths of `make_positive_definite` taken by the tasks
+    top = [] if store is None else heapq.nlargest(top_k or 0, [record["score"] for record in store.records.values()])
+    heapq.heapify(top)  # min-heap of the running top_k scores
+    misses = 0  # results in a row that did not enter the top_k
+    shared = SharedArrays() if share_memory else None
+    try:
+        args = (X_obs, X_int, Precision_mat, reference, lasso_engine)
+        X_obs_w, X_int_w, Precision_mat_w, reference_w, lasso_engine_w = shared.share(args) if share_memory else args
+        # results are received as they complete
+        parallel = Parallel(n_jobs=processes, batch_size=1 if schedule == "cost" or top_k is not None else "auto",
+                            return_as="generator_unordered")
+        results = parallel(delayed(run_with_memory)(process_y_idx_counted, y_idx, X_obs_w, X_int_w, nshuffles, verbose,
+                                                    Precision_mat_w, incremental, reference_w,
+                                                    None if seed is None else [seed, y_idx], mb_index, lasso_engine_w,
+                                                    threads=threads)
+                           for y_idx in y_indices)
+        for ((y_idx, score, length), pd_counts), pid, memory, time_y in results:
+            for key, count in pd_counts.items():
+                pd_repair[key] += count
+                if pid != os.getpid():  # the counters of this process already include tasks run in it
+                    _pd_repair_counts[key] += count
+            root_cause_score[y_idx] = score
+            select_len[y_idx] = length
+            worker_memory[pid] = memory
+            seconds[y_idx] = time_y
+            if store is not None:
+                store.append({"y_idx": int(y_idx), "score": float(score), "select_len": int(length),
+                              "seconds": time_y})
+            if top_k is not None:
+                if len(top) < top_k:
+                    heapq.heappush(top, score)
+                    misses = 0
+                elif score > top[0]:
+                    heapq.heapreplace(top, score)
+                    misses = 0
+                else:
+                    misses += 1
+                if misses >= patience:
+                    with warnings.catch_warnings():  # ignore the warning about the cancelled tasks
+                        warnings.simplefilter("ignore")
+                        results.close()
+                    break
+    finally:
+        if share_memory:
+            shared.close()
+        if store is not None:
+            store.close()
+    n_resumed = 0
+    if store is not None:
+        for y_idx, record in store.records.items():
+            if y_idx not in seconds:
+                root_cause_score[y_idx] = record["score"]
+                select_len[y_idx] = record["select_len"]
+                seconds[y_idx] = record["seconds"]
+                n_resumed += 1
 
     # assign final root cause score for variables that never had maximal Xtilde_i
     idx2 = np.where(root_cause_score == 0)[0]
@@ -247,4 +943,9 @@ def root_cause_discovery_highdim_parallel(
         else:
             root_cause_score = z
 
+    if return_info:
+        info = {"worker_memory": worker_memory, "shared_bytes": shared.nbytes if share_memory else 0,
+                "execution_policy": (processes, threads), "seconds": seconds, "resumed": n_resumed,
+                "complete": len(seconds) == n_candidates, "pd_repair": pd_repair}
+        return root_cause_score, select_len, info
     return root_cause_score, select_len
\ No newline at end of file
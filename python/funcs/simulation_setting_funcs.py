@@ -1,153 +1,300 @@
 import numpy as np
-from scipy import linalg
+from scipy import linalg, sparse
+from scipy.sparse.linalg import spsolve_triangular
+
+# above this many lower triangular entries, the sampled entries are drawn by rejection instead of by a permutation of
+# all of them (which takes 8 bytes per entry); below it, B_random draws the same B for the same seed as it always did
+MAX_PERMUTED_ENTRIES = 2 ** 25
 
 # functions for simulations
-################### Randomly generate lower triangular matrix B
-def B_random(p, s_B, B_value_min, B_value_max):
-    lowertri_index = np.nonzero(np.tril(np.ones((p, p)), -1))
-    num_lowertri_entry = len(lowertri_index[0])
-    num_nonzero_entry = int(s_B * num_lowertri_entry)
-    nonzero_index = np.random.choice(num_lowertri_entry, num_nonzero_entry, replace=False)
+################### `num` distinct random entries (rows, cols) of the strict lower triangle of a p x p matrix, without
+# materializing the triangle: entry (i, j), j < i, has the row-major linear index l = i (i - 1) / 2 + j, hence
+# i = floor((1 + sqrt(1 + 8 l)) / 2), corrected for rounding, and j = l - i (i - 1) / 2
+def lower_triangular_entries(p, num):
+    num_lowertri_entry = p * (p - 1) // 2
+    if num_lowertri_entry <= MAX_PERMUTED_ENTRIES:
+        linear = np.random.choice(num_lowertri_entry, num, replace=False)
+    else:
+        linear = np.unique(np.random.randint(0, num_lowertri_entry, size=num, dtype=np.int64))
+        while len(linear) < num:
+            extra = np.random.randint(0, num_lowertri_entry, size=num - len(linear), dtype=np.int64)
+            linear = np.unique(np.concatenate([linear, extra]))
+    linear = np.asarray(linear, dtype=np.int64)
+    rows = np.floor((1 + np.sqrt(1 + 8 * linear.astype(float))) / 2).astype(np.int64)
+    rows[rows * (rows - 1) // 2 > linear] -= 1
+    rows[rows * (rows + 1) // 2 <= linear] += 1
+    return rows, linear - rows * (rows - 1) // 2
+
+################### Randomly generate lower triangular matrix B, as a CSR matrix with `as_sparse`
+def B_random(p, s_B, B_value_min, B_value_max, as_sparse=False):
+    num_nonzero_entry = int(s_B * (p * (p - 1) // 2))
+    rows, cols = lower_triangular_entries(p, num_nonzero_entry)
+    values = np.random.uniform(B_value_min, B_value_max, num_nonzero_entry)
+    if as_sparse:
+        return sparse.csr_matrix((values, (rows, cols)), shape=(p, p))
     B = np.zeros((p, p))
-    B[lowertri_index[0][nonzero_index], lowertri_index[1][nonzero_index]] = np.random.uniform(B_value_min, B_value_max,
-                                                                                              num_nonzero_entry)
+    B[rows, cols] = values
     return B
 
-################### Randomly generate lower triangular matrix B corresponds to a hub graph
-def B_hub_func(num_hub, size_up_block, size_low_block, intersect_prop, s_B, B_value_min, B_value_max):
+################### Randomly generate lower triangular matrix B corresponds to a hub graph, as a CSR matrix with
+# `as_sparse`. The blocks and hub edges are collected as (row, col, value) triplets, none of them overlap
+def B_hub_func(num_hub, size_up_block, size_low_block, intersect_prop, s_B, B_value_min, B_value_max, as_sparse=False):
     if num_hub < 2:
         intersect_prop = 0
     p = num_hub + num_hub * (size_up_block + size_low_block)
-    B = np.zeros((p, p))
+    rows, cols, values = [], [], []
     B_upper_list, B_lower_list, hub_B_in_vec, hub_B_out_vec = [], [], [], []
     hub_size_in = size_up_block + int(size_up_block * intersect_prop)  # point to hubs
     hub_size_out = size_low_block + int(size_low_block * intersect_prop)  # hubs point to other nodes
 
     for i in range(num_hub):
-        B_upper_list.append(B_random(size_up_block, s_B, B_value_min, B_value_max))
-        B_lower_list.append(B_random(size_low_block, s_B, B_value_min, B_value_max))
+        B_upper_list.append(B_random(size_up_block, s_B, B_value_min, B_value_max, as_sparse=True).tocoo())
+        B_lower_list.append(B_random(size_low_block, s_B, B_value_min, B_value_max, as_sparse=True).tocoo())
         hub_B_in_vec.append(np.random.uniform(B_value_min, B_value_max, hub_size_in))
         hub_B_out_vec.append(np.random.uniform(B_value_min, B_value_max, hub_size_out))
 
     for i in range(num_hub):
         start_index_up = i * size_up_block
-        B[start_index_up:(start_index_up + size_up_block), start_index_up:(start_index_up + size_up_block)] = \
-        B_upper_list[i]
+        rows.append(start_index_up + B_upper_list[i].row)
+        cols.append(start_index_up + B_upper_list[i].col)
+        values.append(B_upper_list[i].data)
 
     for i in range(num_hub):
         start_index_in_row = num_hub * size_up_block + i
         start_index_in_col = max(0, i * size_up_block - int(size_up_block * intersect_prop))
-        B[start_index_in_row, start_index_in_col:(start_index_in_col + len(hub_B_in_vec[i]))] = hub_B_in_vec[i]
+        rows.append(np.full(hub_size_in, start_index_in_row))
+        cols.append(start_index_in_col + np.arange(hub_size_in))
+        values.append(hub_B_in_vec[i])
 
         start_index_out_row = num_hub * size_up_block + num_hub + max(0, i * size_low_block - int(
             size_low_block * intersect_prop))
         start_index_out_col = num_hub * size_up_block + i
-        B[start_index_out_row:(start_index_out_row + len(hub_B_out_vec[i])), start_index_out_col] = hub_B_out_vec[i]
+        rows.append(start_index_out_row + np.arange(hub_size_out))
+        cols.append(np.full(hub_size_out, start_index_out_col))
+        values.append(hub_B_out_vec[i])
 
     for i in range(num_hub):
         start_index_low = num_hub * size_up_block + num_hub + i * size_low_block
-        B[start_index_low:(start_index_low + size_low_block), start_index_low:(start_index_low + size_low_block)] = \
-        B_lower_list[i]
+        rows.append(start_index_low + B_lower_list[i].row)
+        cols.append(start_index_low + B_lower_list[i].col)
+        values.append(B_lower_list[i].data)
 
+    rows, cols, values = np.concatenate(rows), np.concatenate(cols), np.concatenate(values)
+    if as_sparse:
+        return sparse.csr_matrix((values, (rows, cols)), shape=(p, p))
+    B = np.zeros((p, p))
+    B[rows, cols] = values
     return B
 
 
 ################ Rescale B while keeping its support, so that the variance of X is close to the given one
+# Row i of (I - B)^{-1} is e_i + v with v = B[i] (I - B)^{-1}, so that var(X_i) = sigma2_error[i] + q with
+# q = sum_k v_k^2 sigma2_error[k]; dividing B[i] by s divides v by s (B is a DAG, so v_i = 0), hence
+# var(X_i) = sigma2_error[i] + q / s^2 and s is solved in closed form. (I - B)^{-1} is then updated by Sherman-Morrison.
+# When var_X_design[i] <= sigma2_error[i] cannot be reached, B[i] is shrunk as by `max_count` steps of (1 + step_size).
+# A scipy sparse B is rescaled by rescale_B_sparse
 def rescale_B_func(B, var_X_design, sigma2_error, tol, step_size, max_count):
     p = B.shape[1]
-    I = np.identity(p)
     assert step_size < 1, "step_size must be smaller than 1"
+    if sparse.issparse(B):
+        return rescale_B_sparse(B, var_X_design, sigma2_error, tol, step_size, max_count)
 
     # Using [] will point to memory so the value of the input 'sigma2_error' will also change, so we generate a copy
     sigma2_error_copy = sigma2_error.copy()
+    B = B.copy()
+    IB_inv = sem_inverse(B)  # (I - B)^{-1}, kept up to date with B
     for i in range(p):
+        parents = np.nonzero(B[i])[0]
         # if it is a source node
-        if np.sum(B[i] != 0) == 0:
+        if len(parents) == 0:
             sigma2_error_copy[i] = var_X_design[i]
+            continue
         # if it is not a source node
-        elif np.sum(B[i] != 0) > 0:
-            IB_inv_temp = linalg.solve(I - B, np.eye(p))
-            var_temp = (IB_inv_temp[i] * sigma2_error_copy) @ IB_inv_temp[i].T
-            rescale_temp = np.sqrt(np.abs(var_temp - sigma2_error_copy[i]))
-
-            count_while = 0
-            B_temp = B.copy()
-            while abs(var_temp - var_X_design[i]) > tol:
-                if var_temp - var_X_design[i] > 0:
-                    rescale_temp = rescale_temp * (1 + step_size)
-                    B_temp = B.copy()
-                    B_temp[i] = B[i] / rescale_temp
-
-                    IB_inv_temp = linalg.solve(I - B_temp, np.eye(p))
-                    var_temp = (IB_inv_temp[i] * sigma2_error_copy) @ IB_inv_temp[i].T
-                else:
-                    rescale_temp = rescale_temp * (1 - step_size)
-                    B_temp = B.copy()
-                    B_temp[i] = B[i] / rescale_temp
-
-                    IB_inv_temp = linalg.solve(I - B_temp, np.eye(p))
-                    var_temp = (IB_inv_temp[i] * sigma2_error_copy) @ IB_inv_temp[i].T
-                count_while += 1
-                if count_while > max_count:
-                    break
-            B = B_temp  # update B
+        v = B[i, parents] @ IB_inv[parents]
+        q = (v * sigma2_error_copy) @ v
+        if abs(sigma2_error_copy[i] + q - var_X_design[i]) <= tol:
+            continue
+        if var_X_design[i] > sigma2_error_copy[i]:
+            rescale = np.sqrt(q / (var_X_design[i] - sigma2_error_copy[i]))
+        else:
+            rescale = np.sqrt(q) * (1 + step_size) ** (max_count + 1)
+        B[i] = B[i] / rescale
+        # (I - B) gains the rank-one term (1 - 1 / rescale) e_i v_old-row, whose Sherman-Morrison denominator is 1
+        descendants, ancestors = np.nonzero(IB_inv[:, i])[0], np.nonzero(v)[0]
+        IB_inv[np.ix_(descendants, ancestors)] -= (1 - 1 / rescale) * np.outer(IB_inv[descendants, i], v[ancestors])
 
     return B, sigma2_error_copy
 
-# Generate a random or hub DAG for simulation, with permuted variable ordering
+# rescale_B_func for a strictly lower triangular scipy sparse B, returned as a CSR matrix. Instead of the dense
+# (I - B)^{-1}, only the support and values of its row i (the ancestors of i) are kept, built in the order of the rows
+# as e_i + sum_j B[i, j] row_j over the parents j of i, whose rows are final by then. Time and memory scale with the
+# sizes of the ancestor sets, which stay small for sparse and hub DAGs
+def rescale_B_sparse(B, var_X_design, sigma2_error, tol, step_size, max_count):
+    assert step_size < 1, "step_size must be smaller than 1"
+    B = sparse.csr_matrix(B, copy=True)
+    B.eliminate_zeros()
+    if sparse.triu(B).nnz > 0:
+        raise ValueError("a sparse B must be strictly lower triangular")
+    p = B.shape[1]
+
+    sigma2_error_copy = sigma2_error.copy()
+    ancestors, weights = [None] * p, [None] * p  # support and values of row i of (I - B)^{-1}
+    for i in range(p):
+        parents = B.indices[B.indptr[i]:B.indptr[i + 1]]
+        # if it is a source node
+        if len(parents) == 0:
+            sigma2_error_copy[i] = var_X_design[i]
+            ancestors[i], weights[i] = np.array([i]), np.ones(1)
+            continue
+        # if it is not a source node
+        B_i = B.data[B.indptr[i]:B.indptr[i + 1]]  # a view, dividing it rescales B[i]
+        support, position = np.unique(np.concatenate([ancestors[j] for j in parents]), return_inverse=True)
+        v = np.bincount(position, weights=np.concatenate([w * weights[j] for w, j in zip(B_i, parents)]),
+                        minlength=len(support))
+        q = (v * sigma2_error_copy[support]) @ v
+        if abs(sigma2_error_copy[i] + q - var_X_design[i]) > tol:
+            if var_X_design[i] > sigma2_error_copy[i]:
+                rescale = np.sqrt(q / (var_X_design[i] - sigma2_error_copy[i]))
+            else:
+                rescale = np.sqrt(q) * (1 + step_size) ** (max_count + 1)
+            B_i /= rescale
+            v /= rescale
+        ancestors[i], weights[i] = np.append(support, i), np.append(v, 1.0)
+
+    return B, sigma2_error_copy
+
+# error variances as a vector, from a vector, a diagonal matrix or a scipy sparse diagonal matrix
+def error_variances(sigma2_error):
+    if sparse.issparse(sigma2_error):
+        return sigma2_error.diagonal()
+    return np.diag(sigma2_error) if np.ndim(sigma2_error) == 2 else sigma2_error
+
+# Topological order of the DAG of B (B[i, j] != 0 for an edge j -> i): B[np.ix_(order, order)] is strictly lower
+# triangular. B may be a scipy sparse matrix. Raises a ValueError if the graph has a cycle
+def topological_order(B):
+    if sparse.issparse(B):
+        B = sparse.csc_matrix(B, copy=True)
+        B.eliminate_zeros()
+        n_parents = B.getnnz(axis=1)
+        children_of = lambda j: B.indices[B.indptr[j]:B.indptr[j + 1]]
+    else:
+        parents = B != 0
+        n_parents = np.sum(parents, axis=1)
+        children_of = lambda j: np.where(parents[:, j])[0]
+    order = []
+    ready = list(np.where(n_parents == 0)[0])
+    while len(ready) > 0:
+        j = ready.pop()
+        order.append(j)
+        children = children_of(j)
+        n_parents[children] -= 1
+        ready.extend(children[n_parents[children] == 0])
+    if len(order) < B.shape[0]:
+        raise ValueError("B is not the matrix of a DAG")
+    return np.array(order)
+
+# Solution X of (I - B) X = rhs, by a triangular solve in the topological `order` of B (computed if not given), a
+# sparse triangular solve when B is a scipy sparse matrix
+def sem_solve(B, rhs, order=None):
+    if order is None:
+        order = topological_order(B)
+    X = np.empty_like(rhs, dtype=float)
+    if sparse.issparse(B):
+        B = sparse.csr_matrix(B)
+        L = (sparse.identity(B.shape[0], format="csr") - B[order][:, order]).tocsr()  # unit lower triangular
+        X[order] = spsolve_triangular(L, rhs[order], lower=True, unit_diagonal=True)
+        return X
+    L = np.identity(B.shape[0]) - B[np.ix_(order, order)]  # unit lower triangular
+    X[order] = linalg.solve_triangular(L, rhs[order], lower=True, unit_diagonal=True)
+    return X
+
+# (I - B)^{-1}
+def sem_inverse(B, order=None):
+    return sem_solve(B, np.identity(B.shape[0]), order)
+
+# covariance (I - B)^{-1} D (I - B)^{-T} of the SEM X = B X + error, with error variances D = diag(sigma2_error)
+def sem_covariance(B, sigma2_error, order=None):
+    variances = error_variances(sigma2_error)
+    IB_inv = sem_inverse(B, order)
+    return (IB_inv * variances) @ IB_inv.T
+
+# precision matrix (I - B)^T D^{-1} (I - B) of the SEM X = B X + error, whose non-zeros give the true Markov blankets.
+# It is a CSC matrix when B is a scipy sparse matrix
+def sem_precision(B, sigma2_error):
+    variances = error_variances(sigma2_error)
+    if sparse.issparse(B):
+        IB = sparse.identity(B.shape[0], format="csr") - B
+        return (IB.T @ sparse.diags(1 / variances) @ IB).tocsc()
+    IB = np.identity(B.shape[0]) - B
+    return (IB.T / variances) @ IB
+
+# Generate a random or hub DAG for simulation, with permuted variable ordering.
+# With `return_order`, the topological order of B is also returned, i.e. B[np.ix_(order, order)] is lower triangular.
+# With `as_sparse`, B is a CSR matrix and sigma2_error a sparse diagonal matrix, and no p x p dense matrix is formed
 def generate_setting(dag_type, s_B, B_value_min, B_value_max, err_min, err_max, var_X_min, var_X_max,
                      p=0, num_hub=0, size_up_block=0, size_low_block=0, intersect_prop=0,
-                     tol=10, step_size=0.2, max_count=100):
+                     tol=10, step_size=0.2, max_count=100, return_order=False, as_sparse=False):
     if dag_type == "random":
         if p == 0:
             raise ValueError("p is needed for random dag")
-        B_unscaled = B_random(p, s_B, B_value_min, B_value_max)
+        B_unscaled = B_random(p, s_B, B_value_min, B_value_max, as_sparse)
     elif dag_type == "hub":
         if num_hub == 0 or size_up_block == 0 or size_low_block == 0 or intersect_prop == 0:
             raise ValueError("num_hub, size_up_block, size_low_block, and intersect_prop are needed for hub dag")
         p = num_hub + num_hub * (size_up_block + size_low_block)
-        B_unscaled = B_hub_func(num_hub, size_up_block, size_low_block, intersect_prop, s_B, B_value_min, B_value_max)
+        B_unscaled = B_hub_func(num_hub, size_up_block, size_low_block, intersect_prop, s_B, B_value_min, B_value_max,
+                                as_sparse)
 
     sigma2_error_raw = np.random.uniform(err_min, err_max, p)  # rep(var_error,p) # do not make error variance the same!
     var_X_design = np.random.uniform(var_X_min, var_X_max, p)  # preset variance of X we want to get based on the SEM
     B_scaled, sigma2_error_new = rescale_B_func(B_unscaled, var_X_design, sigma2_error_raw, tol=tol, step_size=step_size,
                                                 max_count=max_count)
 
-    # # check that the variance of X is indeed close to the preset one
-    I = np.identity(p)
-    var_X_new = np.diag(np.dot(linalg.solve(I - B_scaled, np.diag(sigma2_error_new)), linalg.inv(I - B_scaled).T))
-    max_diff = np.max(np.abs(var_X_new - var_X_design))
-    if max_diff > tol:
-        print(f"the max difference between var_X_new and var_X_design is {max_diff}")
+    # # check that the variance of X is indeed close to the preset one (it needs the dense covariance, so it is skipped
+    # for a sparse B)
+    if not as_sparse:
+        var_X_new = np.diag(sem_covariance(B_scaled, sigma2_error_new, np.arange(p)))  # B_scaled is lower triangular
+        max_diff = np.max(np.abs(var_X_new - var_X_design))
+        if max_diff > tol:
+            print(f"the max difference between var_X_new and var_X_design is {max_diff}")
 
     ordering = np.random.permutation(np.arange(p))
-    Permut_mat = np.eye(p)[ordering]
-    B = Permut_mat @ B_scaled @ Permut_mat.T
-    sigma2_error = np.diag(sigma2_error_new[ordering])
+    if as_sparse:
+        B = B_scaled[ordering][:, ordering]  # = P B_scaled P^T for the permutation matrix P of `ordering`
+        sigma2_error = sparse.diags(sigma2_error_new[ordering])
+    else:
+        Permut_mat = np.eye(p)[ordering]
+        B = Permut_mat @ B_scaled @ Permut_mat.T
+        sigma2_error = np.diag(sigma2_error_new[ordering])
 
     b = np.random.uniform(-5, 5, p)  # intercept
+    if return_order:
+        return B, sigma2_error, b, np.argsort(ordering)
     return B, sigma2_error, b
 
+# Rows of the SEM X = B X + b + error + delta, i.e. X = (I - B)^{-1} (b + error + delta), with independent Gaussian
+# errors of variances diag(sigma2_error) and one row per row of `delta`. All errors are drawn as one block and all rows
+# are solved in one triangular solve in the topological `order` of B (computed if not given). B and sigma2_error may be
+# scipy sparse matrices
+def sample_sem(B, sigma2_error, b, delta, order=None):
+    variances = error_variances(sigma2_error)
+    error = np.random.normal(size=delta.shape) * np.sqrt(variances)
+    return sem_solve(B, (b + error + delta).T, order).T
+
 # Generate n observartional and m interventional data
-def generate_data(n, m, p, B, sigma2_error, b, int_mean, int_sd):
+def generate_data(n, m, p, B, sigma2_error, b, int_mean, int_sd, order=None):
     # True root causes
     RC = np.random.choice(np.arange(p), size=m, replace=True)
-    I = np.identity(p)
 
-    X_obs = np.zeros((n, p))
-    X_int = np.zeros((m, p))
-    for i in range(n):
-        error = np.random.multivariate_normal(np.repeat(0, p), sigma2_error, 1)
-        X_obs[i, :] = linalg.solve(I - B, (b + error).T).reshape(p)
-    for i in range(m):
-        delta = np.repeat(0, p)
-        delta[RC[i]] = np.random.normal(int_mean, int_sd, 1)
-        error = np.random.multivariate_normal(np.repeat(0, p), sigma2_error, 1)
-        X_int[i, :] = linalg.solve(I - B, (b + error + delta).T).reshape(p)
+    # the interventional rows are shifted at their root cause
+    delta = np.zeros((n + m, p))
+    delta[n + np.arange(m), RC] = np.random.normal(int_mean, int_sd, m)
+    X = sample_sem(B, sigma2_error, b, delta, order)
+    X_obs, X_int = X[:n], X[n:]
 
     return X_obs, X_int, RC
 
-def generate_data_latent(n, m, p, latent_proportion, B, sigma2_error, b, int_mean, int_sd):
+def generate_data_latent(n, m, p, latent_proportion, B, sigma2_error, b, int_mean, int_sd, order=None):
     # randomly sample some variables as latent
     latent_idx = np.random.choice(np.arange(p), size=int(latent_proportion * p), replace=False)
     non_latent_idx = np.setdiff1d(np.arange(p), latent_idx)
@@ -155,18 +302,10 @@ def generate_data_latent(n, m, p, latent_proportion, B, sigma2_error, b, int_mea
     # randomly sample true root causes from non-latent variables
     RC = np.random.choice(non_latent_idx, size=m, replace=True)
 
-    I = np.identity(p)
-
-    X_obs = np.zeros((n, p))
-    X_int = np.zeros((m, p))
-    for i in range(n):
-        error = np.random.multivariate_normal(np.repeat(0, p), sigma2_error, 1)
-        X_obs[i, :] = linalg.solve(I - B, (b + error).T).reshape(p)
-    for i in range(m):
-        delta = np.repeat(0, p)
-        delta[RC[i]] = np.random.normal(int_mean, int_sd, 1)
-        error = np.random.multivariate_normal(np.repeat(0, p), sigma2_error, 1)
-        X_int[i, :] = linalg.solve(I - B, (b + error + delta).T).reshape(p)
+    delta = np.zeros((n + m, p))
+    delta[n + np.arange(m), RC] = np.random.normal(int_mean, int_sd, m)
+    X = sample_sem(B, sigma2_error, b, delta, order)
+    X_obs, X_int = X[:n], X[n:]
 
     # remove latent variables
     X_obs_new = X_obs[:, non_latent_idx]
@@ -176,4 +315,4 @@ def generate_data_latent(n, m, p, latent_proportion, B, sigma2_error, b, int_mea
     for i in range(m):
         RC_new[i] = RC[i] - np.sum(latent_idx < RC[i])
 
-    return X_obs_new, X_int_new, RC_new
\ No newline at end of file
+    return X_obs_new, X_int_new, RC_new
@@ -0,0 +1,91 @@
+import numpy as np
+import sys
+import os
+import warnings
+from sklearn.linear_model import LassoCV, lasso_path
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from funcs.markov_blanket_funcs import *
+
+
+# n x p observations of a random linear SEM, so that the nodewise Lassos select several variables
+def make_sem_data(n, p, seed, density=0.15):
+    rng = np.random.default_rng(seed)
+    B = np.tril(rng.normal(size=(p, p)) * (rng.random((p, p)) < density), -1)
+    return rng.normal(size=(n, p)) @ np.linalg.inv(np.eye(p) - B).T
+
+
+# `nodewise_lasso(y_idx, X_obs)` with the coordinate descent of sklearn run to convergence, as the reference of the
+# exact engines: `LassoCV`, or when it selects at most one variable the walk of `lasso_target_support`
+def reference_nodewise_lasso(y_idx, X_obs, eps=1e-3, tol=1e-12):
+    n, p = X_obs.shape
+    y, predictors = X_obs[:, y_idx], np.delete(np.arange(p), y_idx)
+    X = X_obs[:, predictors]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        lasso_cv = LassoCV(eps=eps, tol=tol, max_iter=10 ** 6).fit(X, y)
+        beta, alpha = lasso_cv.coef_, lasso_cv.alpha_
+        if np.sum(beta != 0) <= 1:
+            alpha_max = np.max(np.abs(X.T @ y)) / n
+            alphas = np.logspace(np.log10(alpha_max * eps), np.log10(alpha_max), num=100)[::-1]
+            _, coefs, _ = lasso_path(X, y, alphas=alphas, tol=tol, max_iter=10 ** 6)
+            num_nonzeros = np.sum(coefs != 0, axis=0)
+            stop = np.argmax(num_nonzeros >= n / 2) if np.any(num_nonzeros >= n / 2) else len(alphas) - 1
+            alpha_idx = np.argmin(np.abs(num_nonzeros[:stop + 1] - n / 2))
+            beta, alpha = coefs[:, alpha_idx], alphas[alpha_idx]
+    return predictors[beta != 0], alpha
+
+
+# the LARS-Lasso homotopy gives the Lasso path of sklearn's coordinate descent
+def test_lasso_knots_match_lasso_path():
+    for seed in range(3):
+        X = make_sem_data(150, 30, seed)
+        X = X - np.mean(X, axis=0)
+        n = len(X)
+        y, Z = X[:, 0], X[:, 1:]
+        alphas = np.logspace(0, -3, 30) * np.max(np.abs(Z.T @ y)) / n
+        _, coefs_ref, _ = lasso_path(Z, y, alphas=alphas, tol=1e-12, max_iter=10 ** 6)
+        knots = lasso_knots(Z.T @ y / n, lambda k: Z.T @ Z[:, k] / n, Z.shape[1], alphas[-1])
+        support, coefs = interpolate_knots(knots, alphas)
+        coefs_full = np.zeros((len(alphas), Z.shape[1]))
+        coefs_full[:, support] = coefs
+        assert np.allclose(coefs_full, coefs_ref.T, atol=1e-8)
+
+
+# `GramLasso` selects the Markov blankets and penalties of the converged `nodewise_lasso` at n > p, with CV
+# (correlated variables) and with the fallback to n/2 variables (independent variables)
+def test_gram_lasso_matches_lasso_cv():
+    for X in [make_sem_data(120, 20, seed=0), np.random.default_rng(1).normal(size=(60, 40))]:
+        gram_lasso = GramLasso(X)
+        for y_idx in range(X.shape[1]):
+            selected_idx, _, alpha = gram_lasso(y_idx)
+            selected_ref, alpha_ref = reference_nodewise_lasso(y_idx, X)
+            assert set(selected_idx) == set(selected_ref)
+            assert np.isclose(alpha, alpha_ref)
+
+
+# the sequential strong rule with KKT checks gives the Lasso path on all predictors, at n > p and at n < p, from an
+# empty working set or from one seeded with unrelated predictors
+def test_strong_rule_path_matches_lasso_path():
+    for n, p, seed in [(150, 30, 0), (50, 200, 1)]:
+        X = make_sem_data(n, p, seed)
+        X = X - np.mean(X, axis=0)
+        y, Z = X[:, -1], X[:, :-1]
+        alphas = np.logspace(0, -2, 40) * np.max(np.abs(Z.T @ y)) / n
+        _, coefs_ref, _ = lasso_path(Z, y, alphas=alphas, tol=1e-12, max_iter=10 ** 6)
+        for working in [None, np.arange(5)]:
+            assert np.allclose(strong_rule_path(Z, y, alphas, working), coefs_ref.T, atol=1e-8)
+
+
+# CV with the strong rule picks the penalty of the converged `LassoCV`, and the exact screens of `nodewise_lasso`
+# ("strong", and "sis" with `kkt_check`) select its Markov blankets
+def test_strong_rule_lasso_cv_matches_lasso_cv():
+    X = make_sem_data(120, 20, seed=2)
+    for y_idx in range(X.shape[1]):
+        selected_ref, alpha_ref = reference_nodewise_lasso(y_idx, X)
+        for screen in [dict(screen="strong"), dict(screen="sis", kkt_check=True, screen_size=5)]:
+            selected_idx, _, alpha = nodewise_lasso(y_idx, X, **screen)
+            assert set(selected_idx) == set(selected_ref)
+            assert np.isclose(alpha, alpha_ref)
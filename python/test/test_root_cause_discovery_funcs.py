@@ -0,0 +1,48 @@
+import numpy as np
+import sys
+import os
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from funcs.root_cause_discovery_funcs import *
+
+
+# observational cohort with correlated variables and one patient with a shifted variable
+def make_cohort(n=200, p=12, seed=0):
+    rng = np.random.default_rng(seed)
+    X_obs = rng.normal(size=(n, p)) @ rng.normal(size=(p, p)) / np.sqrt(p) + rng.normal(size=p)
+    X_int = X_obs[0] + np.eye(p)[3] * 6
+    return X_obs, X_int
+
+
+# the Schur-complement engine gives the |Xtilde| of `root_cause_discovery` for each permutation of a threshold
+def test_schur_matches_per_permutation():
+    X_obs, X_int = make_cohort()
+    mu, sigma = estimate_mean_cov(X_obs)
+    z = zscore(X_obs, X_int)
+    for threshold in [0.2, 0.6, 1.0]:
+        perms = np.asarray(compute_permutations(z, threshold=threshold, nshuffles=3, shuffle_normal=False, seed=1))
+        Xtilde = root_cause_discovery_schur(mu, sigma, X_int, perms, np.sum(z <= threshold))
+        for perm, row in zip(perms, Xtilde):
+            assert np.allclose(row, root_cause_discovery(X_obs, X_int, perm), rtol=1e-10, atol=1e-12)
+
+
+# along an ascending sweep, `IncrementalSchur` gives the |Xtilde| of `root_cause_discovery` for the permutations whose
+# normal block is in migration order, and the aberrant block of `root_cause_discovery_schur`
+def test_incremental_schur_matches_per_permutation():
+    X_obs, X_int = make_cohort(seed=1)
+    mu, sigma = estimate_mean_cov(X_obs)
+    z = zscore(X_obs, X_int)
+    sweep = IncrementalSchur(mu, sigma, X_int)
+    for threshold in get_aberrant_thresholds(z, thre_min=0.1, thre_max=5, thre_seq=0.2):
+        perms = np.asarray(compute_permutations(z, threshold=threshold, nshuffles=2, shuffle_normal=False, seed=2))
+        n_normal = np.sum(z <= threshold)
+        sweep.advance(z, threshold)
+        Xtilde = sweep.root_cause_discovery(perms[:, n_normal:])
+        for perm, row in zip(perms, Xtilde):
+            perm_incremental = np.concatenate([sweep.idx_normal, perm[n_normal:]])
+            assert np.allclose(row, root_cause_discovery(X_obs, X_int, perm_incremental), rtol=1e-8, atol=1e-10)
+        aberrant = perms[0, n_normal:]
+        Xtilde_schur = root_cause_discovery_schur(mu, sigma, X_int, perms, n_normal)
+        assert np.allclose(Xtilde[:, aberrant], Xtilde_schur[:, aberrant], rtol=1e-8, atol=1e-10)
@@ -0,0 +1,47 @@
+import numpy as np
+import sys
+import os
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from funcs.simulation_setting_funcs import *
+
+
+# the closed-form rescaling keeps the support of B and reaches the designed variance of every variable, except those
+# whose error variance is already above it, whose row of B is shrunk until their variance is their error variance
+def test_rescale_B_reaches_designed_variances():
+    np.random.seed(0)
+    p = 60
+    B = B_random(p, 0.2, -1, 1)
+    sigma2_error = np.random.uniform(1, 5, p)
+    var_X_design = np.random.uniform(1, 50, p)
+    B_scaled, sigma2_error_new = rescale_B_func(B, var_X_design, sigma2_error, tol=1e-10, step_size=0.2,
+                                                max_count=100)
+    assert np.array_equal(B_scaled != 0, B != 0)
+    var_X = np.diag(sem_covariance(B_scaled, sigma2_error_new))
+    reachable = (var_X_design > sigma2_error) | ~np.any(B != 0, axis=1)
+    assert 0 < np.sum(~reachable) < p
+    assert np.allclose(var_X[reachable], var_X_design[reachable], rtol=1e-8)
+    assert np.allclose(var_X[~reachable], sigma2_error_new[~reachable], rtol=1e-8)
+
+
+# with `as_sparse`, the same seed gives the same setting, precision matrix and data as the dense matrices
+def test_sparse_setting_matches_dense():
+    for dag_type, kwargs in [("random", dict(p=80)),
+                             ("hub", dict(num_hub=3, size_up_block=10, size_low_block=8, intersect_prop=0.3))]:
+        settings, data = [], []
+        for as_sparse in [False, True]:
+            np.random.seed(1)
+            B, sigma2_error, b, order = generate_setting(dag_type, 0.2, -1, 1, 1, 5, 10, 50, return_order=True,
+                                                         as_sparse=as_sparse, **kwargs)
+            settings.append((B, sigma2_error, b, order, sem_precision(B, sigma2_error)))
+            data.append(generate_data(50, 2, len(b), B, sigma2_error, b, 10, 1, order))
+        (B, sigma2_error, b, order, precision), (B_sp, sigma2_error_sp, b_sp, order_sp, precision_sp) = settings
+        assert sparse.issparse(B_sp) and sparse.issparse(precision_sp)
+        assert np.allclose(B_sp.toarray(), B, rtol=1e-10, atol=1e-12)
+        assert np.allclose(sigma2_error_sp.toarray(), sigma2_error)
+        assert np.array_equal(b_sp, b) and np.array_equal(order_sp, order)
+        assert np.allclose(precision_sp.toarray(), precision, rtol=1e-10, atol=1e-12)
+        for dense, sparse_ in zip(data[0], data[1]):
+            assert np.allclose(sparse_, dense, rtol=1e-10, atol=1e-10)